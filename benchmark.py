@@ -0,0 +1,463 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Timing benchmarks for the C-Snake code generator
+
+Run without arguments for everything, or name the benchmarks to run. The
+workload suite can be saved as a baseline and compared against later:
+
+    python3 benchmark.py suite --save baseline.json
+    python3 benchmark.py suite --compare baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from csnake import *
+
+
+def emit_lines(count):
+    """time emitting count indented lines into a CodeWriter"""
+    cw = CodeWriter()
+    start = time.perf_counter()
+    cw.open_brace()
+    for i in range(count):
+        cw.add_line("table[{0}] = {0};".format(i), comment="entry")
+    cw.close_brace()
+    text = cw.text
+    return time.perf_counter() - start, len(text)
+
+
+def bench_add_line():
+    """emit time should grow linearly with the number of lines"""
+    print("add_line scaling")
+    base = None
+    for count in (25000, 50000, 100000, 200000, 400000):
+        elapsed, size = emit_lines(count)
+        per_line = elapsed / count
+        if base is None:
+            base = per_line
+        print("  {0:>7} lines {1:>10} chars {2:8.3f} s "
+              "{3:6.3f} us/line (x{4:.2f})".format(
+                  count, size, elapsed, per_line * 1e6, per_line / base))
+
+
+def peak_memory(count, sink=None):
+    """peak traced memory while emitting count lines"""
+    tracemalloc.start()
+    cw = CodeWriter(sink=sink)
+    for i in range(count):
+        cw.add_line("table[{0}] = {0};".format(i), comment="entry")
+    cw.flush()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def bench_streaming():
+    """memory use should stay flat when streaming to a sink"""
+    print("peak memory, in memory vs. streaming")
+    with open(os.devnull, 'w') as null:
+        for count in (25000, 100000, 400000):
+            print("  {0:>7} lines {1:10.1f} kB {2:10.1f} kB".format(
+                count,
+                peak_memory(count) / 1024,
+                peak_memory(count, null) / 1024))
+
+
+def bench_initialization():
+    """time array initializers of growing size"""
+    print("array initialization")
+    for count in (100000, 200000, 400000, 800000):
+        flat = Variable("table", "uint8_t",
+                        value=[i % 256 for i in range(count)],
+                        value_opts='0x{0:02x}')
+        rows = Variable("rows", "uint8_t",
+                        value=[[i % 256 for i in range(16)]
+                               for _ in range(count // 16)],
+                        value_opts='0x{0:02x}')
+        timings = []
+        for var in (flat, rows):
+            start = time.perf_counter()
+            var.initialization()
+            timings.append(time.perf_counter() - start)
+        print("  {0:>7} elements {1:8.3f} s flat {2:8.3f} s rows".format(
+            count, *timings))
+
+
+def register_map(count):
+    """build a register map of count registers and an enum of their ids"""
+    regs = Enum("RegisterId_t", prefix="REG_")
+    block = Struct("RegisterBlock_t")
+    for i in range(count):
+        name = "reg{0}".format(i)
+        regs.add_value(name, value=i, comment="register")
+        block.add_variable(Variable(name, "uint32_t", qualifiers="volatile"))
+    return regs, block
+
+
+def bench_register_map(count=500000):
+    """memory and time to model a large register map"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    model = register_map(count)
+    elapsed = time.perf_counter() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print("register map of {0} entries: {1:.1f} MB in {2:.3f} s".format(
+        count, size / 2**20, elapsed))
+    return model
+
+
+def sparse_table(count=1000000):
+    """a mostly zero table with a few values and a long run of 0xff"""
+    table = [0] * count
+    for i in range(0, count, 997):
+        table[i] = i % 200 + 1
+    table[count // 2:count // 2 + count // 10] = [0xff] * (count // 10)
+    return table
+
+
+def bench_compress():
+    """size and time of a sparse table, uncompressed and compressed"""
+    print("sparse table of 1M elements")
+    table = sparse_table()
+    for compress in (None, "sparse", "ranges"):
+        var = Variable("table", "uint8_t", value=table, compress=compress)
+        start = time.perf_counter()
+        size = len(var.initialization())
+        print("  {0:<8}{1:10.1f} kB {2:8.3f} s".format(
+            str(compress), size / 1024, time.perf_counter() - start))
+
+
+def dispatch_program(dispatch, lookups):
+    """C program timing the dispatch of lookups, repeated argv[1] times"""
+    cw = CodeWriter()
+    cw.include("<stdio.h>")
+    cw.include("<stdlib.h>")
+    cw.include("<time.h>")
+    cw.add_line()
+    cw.add_dispatch(dispatch)
+    cw.add_line()
+    cw.add_variable_initialization(
+        Variable("lookups", "int", qualifiers="static const", value=lookups))
+    cw.add_line()
+    cw.add_line("int main(int argc, char **argv)")
+    cw.open_brace()
+    cw.add_line("int repeat = argc > 1 ? atoi(argv[1]) : 1;")
+    cw.add_line("volatile long sum = 0;")
+    cw.add_line("clock_t start = clock();")
+    cw.add_line("for (int r = 0; r < repeat; r++)")
+    cw.tab_in()
+    cw.add_line("for (int i = 0; i < {0}; i++)".format(len(lookups)))
+    cw.tab_in()
+    cw.add_line("sum += {0}(lookups[i]);".format(dispatch.name))
+    cw.tab_out()
+    cw.tab_out()
+    cw.add_line('printf("%f\\n", (double)(clock() - start) / CLOCKS_PER_SEC);')
+    cw.add_line("return 0;")
+    cw.close_brace()
+    return cw.text
+
+
+def bench_dispatch(repeat=200):
+    """compile and time the dispatch strategies with gcc"""
+    print("dispatch with gcc -O2")
+    compiler = shutil.which("gcc")
+    if compiler is None:
+        print("  gcc not found, skipped")
+        return
+    rng = random.Random(1)
+    key_sets = {
+        "dense": rng.sample(range(1200), 1000),
+        "sparse": rng.sample(range(1 << 20), 2000),
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, "dispatch.c")
+        program = os.path.join(directory, "dispatch")
+        for density, keys in key_sets.items():
+            cases = {key: key * 7 % 1000 + 1 for key in keys}
+            # half hits, half misses
+            lookups = ([rng.choice(keys) for _ in range(5000)] +
+                       [rng.randrange(max(keys) + 1) for _ in range(5000)])
+            rng.shuffle(lookups)
+            for strategy in ("auto", "switch", "search", "table"):
+                dispatch = Dispatch("dispatch", cases, strategy=strategy)
+                with open(source, "w") as file:
+                    file.write(dispatch_program(dispatch, lookups))
+                start = time.perf_counter()
+                subprocess.run([compiler, "-O2", "-o", program, source],
+                               check=True)
+                compiled = time.perf_counter() - start
+                seconds = float(subprocess.run(
+                    [program, str(repeat)], check=True,
+                    stdout=subprocess.PIPE).stdout)
+                print("  {0:<7}{1:<14}compile {2:6.2f} s {3:8.2f} ns/lookup"
+                      .format(density, strategy + (
+                          " (" + dispatch.choose_strategy() + ")"
+                          if strategy == "auto" else ""), compiled,
+                              seconds / repeat / len(lookups) * 1e9))
+
+
+def check_dispatch(low=-600, high=600):
+    """compile the dispatch strategies with gcc and compare their results
+
+    Every key from low to high is looked up with each strategy, over dense
+    and sparse cases with negative keys. Returns the number of mismatches.
+    """
+    print("dispatch cross-check with gcc, keys {0}..{1}".format(low, high))
+    compiler = shutil.which("gcc")
+    if compiler is None:
+        print("  gcc not found, skipped")
+        return 0
+    rng = random.Random(2)
+    key_sets = {
+        "dense": rng.sample(range(-500, 500), 800),
+        "sparse": rng.sample(range(-500, 500), 40),
+        "few": [-3, 0, 5, 9],
+    }
+    strategies = ("table", "search", "switch")
+    mismatches = 0
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, "check.c")
+        program = os.path.join(directory, "check")
+        for density, keys in key_sets.items():
+            cases = {key: key * 7 % 1000 + 1 for key in keys}
+            cw = CodeWriter()
+            cw.include("<stdio.h>")
+            cw.add_line()
+            for strategy in strategies:
+                cw.add_dispatch(Dispatch("lookup_" + strategy, cases,
+                                         default=-1, strategy=strategy))
+                cw.add_line()
+            cw.add_line("int main(void)")
+            cw.open_brace()
+            cw.add_line("for (int key = {0}; key <= {1}; key++)".format(
+                low, high))
+            cw.tab_in()
+            cw.add_line('printf("{0}\\n", {1});'.format(
+                " ".join("%d" for _ in strategies),
+                ", ".join("lookup_{0}(key)".format(strategy)
+                          for strategy in strategies)))
+            cw.tab_out()
+            cw.add_line("return 0;")
+            cw.close_brace()
+            with open(source, "w") as file:
+                file.write(cw.text)
+            subprocess.run([compiler, "-O2", "-o", program, source],
+                           check=True)
+            lines = subprocess.run([program], check=True,
+                                   stdout=subprocess.PIPE,
+                                   universal_newlines=True).stdout.split("\n")
+            failed = 0
+            for i, key in enumerate(range(low, high + 1)):
+                expected = [cases.get(key, -1)] * len(strategies)
+                if i >= len(lines) or list(map(int, lines[i].split())) != \
+                        expected:
+                    failed += 1
+            print("  {0:<7}{1} mismatches".format(density, failed))
+            mismatches += failed
+    return mismatches
+
+
+# workload suite: each workload prepares its input (untimed) and returns the
+# number of elements it handles and a function generating the code, which
+# returns the number of characters generated, optionally followed by a
+# function cleaning up after the run (untimed as well)
+
+def workload_table(count=1000000):
+    """a flat table of a million numbers"""
+    var = Variable("table", "uint16_t", value=[i % 65536 for i in range(count)])
+    return count, lambda: len(var.initialization())
+
+
+def nested(depth, width, start=0):
+    """a depth-dimensional list of width**depth consecutive numbers"""
+    if depth == 1:
+        return list(range(start, start + width))
+    step = width ** (depth - 1)
+    return [nested(depth - 1, width, start + i * step) for i in range(width)]
+
+
+def workload_deep_array(depth=9, width=4):
+    """a deep multidimensional array"""
+    var = Variable("deep", "int32_t", value=nested(depth, width))
+    return width ** depth, lambda: len(var.initialization())
+
+
+def workload_shape(depth=9, width=4):
+    """shape inference and validation of a deep multidimensional array"""
+    array = nested(depth, width)
+
+    def run():
+        shape(array, validate=True)
+        return 0
+    return width ** depth, run
+
+
+def workload_structs(count=50000):
+    """an array of structs printed as designated initializers"""
+    value = [{"id": i, "flags": i & 0xff, "gain": i * 0.5,
+              "taps": [i, i + 1, i + 2]} for i in range(count)]
+    var = Variable("channels", "struct Channel", value=value)
+    return count * 6, lambda: len(var.initialization())
+
+
+def workload_enum(count=10000):
+    """an enum of ten thousand values"""
+    enum = Enum("Id_t", prefix="ID_")
+    for i in range(count):
+        enum.add_value("value{0}".format(i), value=i, comment="id")
+
+    def run():
+        cw = CodeWriter()
+        cw.add_enum(enum)
+        return len(cw.text)
+    return count, run
+
+
+def workload_add_line(count=100000):
+    """a file of a hundred thousand lines"""
+    def run():
+        cw = CodeWriter()
+        cw.open_brace()
+        for i in range(count):
+            cw.add_line("table[{0}] = {0};".format(i), comment="entry")
+        cw.close_brace()
+        return len(cw.text)
+    return count, run
+
+
+def workload_write_to_file(count=100000):
+    """writing a hundred thousand lines to a file"""
+    cw = CodeWriter()
+    for i in range(count):
+        cw.add_line("table[{0}] = {0};".format(i))
+    directory = tempfile.TemporaryDirectory()
+    path = os.path.join(directory.name, "out.c")
+
+    def run():
+        cw.write_to_file(path)
+        return os.path.getsize(path)
+    return count, run, directory.cleanup
+
+
+WORKLOADS = [
+    ("table_1d", workload_table),
+    ("deep_array", workload_deep_array),
+    ("shape", workload_shape),
+    ("struct_array", workload_structs),
+    ("enum_10k", workload_enum),
+    ("add_line_100k", workload_add_line),
+    ("write_to_file", workload_write_to_file),
+]
+
+
+def run_suite(repeat=3):
+    """best time of each workload, with throughput in elements/s and MB/s"""
+    print("workload suite (best of {0})".format(repeat))
+    results = {}
+    for name, workload in WORKLOADS:
+        best = None
+        for _ in range(repeat):
+            elements, run, *cleanup = workload()
+            try:
+                start = time.perf_counter()
+                size = run()
+                elapsed = time.perf_counter() - start
+            finally:
+                for function in cleanup:
+                    function()
+            if best is None or elapsed < best:
+                best = elapsed
+        results[name] = {"elements": elements, "chars": size,
+                         "seconds": best}
+        print("  {0:<14}{1:8.3f} s {2:12.0f} elements/s {3:8.1f} MB/s".format(
+            name, best, elements / best, size / best / 1e6))
+    return results
+
+
+def save_baseline(results, path):
+    """store suite results as a baseline to compare later runs with"""
+    with open(path, 'w') as file:
+        json.dump({"python": platform.python_version(),
+                   "machine": platform.machine(),
+                   "results": results}, file, indent=2, sort_keys=True)
+    print("baseline saved to {0}".format(path))
+
+
+def compare_baseline(results, path, tolerance=0.1):
+    """compare suite results with a baseline, returning the regressions
+
+    A workload regressed when it got slower than the baseline by more than
+    tolerance (a fraction of the baseline time).
+    """
+    with open(path) as file:
+        baseline = json.load(file)["results"]
+    print("compared to {0}".format(path))
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            print("  {0:<14}     new".format(name))
+            continue
+        ratio = result["seconds"] / baseline[name]["seconds"]
+        regressed = ratio > 1 + tolerance
+        if regressed:
+            regressions.append(name)
+        print("  {0:<14}{1:8.2f}x time{2}".format(
+            name, ratio, "  REGRESSION" if regressed else ""))
+    return regressions
+
+
+BENCHMARKS = {
+    "add_line": bench_add_line,
+    "streaming": bench_streaming,
+    "initialization": bench_initialization,
+    "register_map": bench_register_map,
+    "compress": bench_compress,
+    "dispatch": bench_dispatch,
+    "check_dispatch": check_dispatch,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("names", nargs="*",
+                        help="benchmarks to run: {0} or suite "
+                             "(default: all)".format(", ".join(BENCHMARKS)))
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs of each suite workload, best one counts")
+    parser.add_argument("--save", metavar="FILE",
+                        help="store the suite results as a baseline")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="compare the suite results with a baseline")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="slowdown reported as regression (default 0.1)")
+    args = parser.parse_args()
+
+    names = args.names or list(BENCHMARKS) + ["suite"]
+    unknown = set(names) - set(BENCHMARKS) - {"suite"}
+    if unknown:
+        parser.error("unknown benchmark: {0}".format(", ".join(sorted(unknown))))
+    failed = False
+    for name in names:
+        if name == "check_dispatch":
+            failed = check_dispatch() > 0 or failed
+        elif name in BENCHMARKS:
+            BENCHMARKS[name]()
+    if "suite" in names:
+        results = run_suite(args.repeat)
+        if args.save:
+            save_baseline(results, args.save)
+        if args.compare and compare_baseline(results, args.compare,
+                                             args.tolerance):
+            failed = True
+    if failed:
+        sys.exit(1)
@@ -1,23 +1,603 @@
 # -*- coding: utf-8 -*-
+import asyncio
+import gzip
+import hashlib
+import inspect
+import io
+import json
+import lzma
+import math
+import mmap
+import os
+import pickle
+import re
+import tarfile
+import tempfile
+import threading
+import time
+import types
+import weakref
+import zipfile
+from collections.abc import Iterator
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from datetime import date
+from functools import lru_cache, partial
+from itertools import count, groupby, islice
+from operator import attrgetter
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional, only needed for ndarray values
+    np = None
+
+try:
+    import zstandard
+except ImportError:  # zstandard is optional, only needed for zstd output
+    zstandard = None
 
 # public helper functions
 
-def shape(array):
-    """Return dimensions (shape) of a multidimensional list"""
+def shape(array, validate=False):
+    """Return dimensions (shape) of a multidimensional list
+
+    The shape is read off the first element of every level. With validate,
+    the whole structure is checked in one pass and ValueError is raised for
+    ragged arrays.
+    """
     # strings should return nothing
     if isinstance(array, str):
         return ''
+    # arrays and buffers know their own shape
+    if isinstance(array, (bytes, bytearray)):
+        return [len(array)]
+    if isinstance(array, _BUFFERS):
+        return list(array.shape)
     curr = array
     shp = []
     while True:
-        if isinstance(curr, dict):
-            return shp
+        if isinstance(curr, (dict, str)):
+            break
         try:
             shp.append(len(curr))
             curr = curr[0]
         except (TypeError, IndexError):
-            return shp
+            break
+    if validate:
+        _validate_shape(array, shp)
+    return shp
+
+
+def narrowest_type(value):
+    """Return the smallest stdint.h type holding every integer in value
+
+    value may be an integer, a (nested) list, a buffer or an ndarray, whose
+    range is found vectorized. Unsigned types are picked for values that are
+    not negative.
+    """
+    span = _int_range(value)
+    low, high = span if span is not None else (0, 0)
+    for bits in (8, 16, 32, 64):
+        if low >= 0 and high < 1 << bits:
+            return 'uint{0}_t'.format(bits)
+        if low < 0 and -(1 << bits - 1) <= low and high < 1 << bits - 1:
+            return 'int{0}_t'.format(bits)
+    raise ValueError('values from {0} to {1} do not fit in 64 bits'.format(
+        low, high))
+
+
+# private helper functions
+
+_CONTAINERS = (list, tuple, dict)  # values printed as braced initializers
+_BUFFERS = (bytes, bytearray, memoryview)  # buffer protocol values
+if np is not None:
+    _BUFFERS += (np.ndarray, )
+_ARRAYS = _CONTAINERS + _BUFFERS
+_SEQUENCES = (list, tuple) + _BUFFERS  # values with elements along a dimension
+_NUMBERS = {int, float}  # element types a row can be formatted in bulk
+_TABLE_LIMIT = 65536  # largest value range formatted through a lookup table
+_END = object()  # marks the end of an iterator
+_MIN_RANGE = 4  # equal values printed as a [first ... last] range
+
+
+def _int_range(value):
+    """lowest and highest integer in a (nested) value, None if it is empty
+
+    Raises TypeError for values other than integers.
+    """
+    if isinstance(value, (int, bool)):
+        return value, value
+    if np is not None and isinstance(value, (np.ndarray, np.integer)):
+        if value.dtype.kind not in 'biu':
+            raise TypeError('not an integer array: {0}'.format(value.dtype))
+        if not value.size:
+            return None
+        return int(value.min()), int(value.max())
+    if isinstance(value, (bytes, bytearray)):
+        return (min(value), max(value)) if value else None
+    if isinstance(value, memoryview):
+        value = value.tolist()
+    if not isinstance(value, (list, tuple)):
+        raise TypeError('not an integer: {0!r}'.format(value))
+    if set(map(type, value)) <= {int, bool}:
+        return (min(value), max(value)) if value else None
+    low = high = None
+    for item in value:
+        span = _int_range(item)
+        if span is None:
+            continue
+        if low is None or span[0] < low:
+            low = span[0]
+        if high is None or span[1] > high:
+            high = span[1]
+    return None if low is None else (low, high)
+
+
+def _validate_shape(array, shp):
+    """raise ValueError unless array is a regular array of dimensions shp"""
+    level = [array]
+    for depth, size in enumerate(shp):
+        items = []
+        for item in level:
+            if not isinstance(item, _SEQUENCES) or len(item) != size:
+                raise ValueError(
+                    'ragged array: expected {size} elements at depth {depth}, '
+                    'got {item!r:.60}'.format(
+                        size=size, depth=depth, item=item))
+            items.extend(item)
+        level = items
+    for item in level:
+        if isinstance(item, _SEQUENCES):
+            raise ValueError(
+                'ragged array: unexpected array at depth {depth}: '
+                '{item!r:.60}'.format(depth=len(shp), item=item))
+
+
+class _IntTable(dict):
+    """formatted integers, filled in the first time each value is looked up"""
+
+    def __init__(self, number):
+        super().__init__()
+        self.number = number
+
+    def __missing__(self, value):
+        text = self.number(value)
+        if len(self) < _TABLE_LIMIT:
+            self[value] = text
+        return text
+
+
+class _Formatter:
+    """formats initializer values as requested by a Variable's value_opts
+
+    value_opts may be None, a format string or a callable returning the text
+    of a number. Integers formatted through a format string go through a
+    lookup table, so repeated values (bytes, small enums) are formatted once.
+    """
+
+    def __init__(self, value_opts=None):
+        if value_opts is None:
+            self.number = str
+        elif callable(value_opts):
+            self.number = value_opts
+        else:
+            self.number = value_opts.format
+        # callables might not be pure, so their results are not memoized
+        self.ints = None if callable(value_opts) else _IntTable(self.number)
+        self.plain = value_opts is None
+
+    def __call__(self, value):
+        """format a single initializer value"""
+        if isinstance(value, str):
+            return "\"{val}\"".format(val=value)
+        elif isinstance(value, (int, float)):
+            return self.number(value)
+        elif np is not None and isinstance(value, np.bool_):
+            return self.number(int(value))
+        elif np is not None and isinstance(value, (np.integer, np.floating)):
+            return self.number(value)
+        raise TypeError('cannot print initializer value {0!r} of type '
+                        '{1}'.format(value, type(value).__name__))
+
+    def row(self, row):
+        """format a row of numbers in bulk (None if it has other values)"""
+        types = set(map(type, row))
+        if not types <= _NUMBERS:
+            return None
+        if types == {int} and self.ints is not None:
+            return map(self.ints.__getitem__, row)
+        return map(self.number, row)
+
+    def ndarray(self, flat):
+        """format a flat ndarray, vectorized where the dtype allows it"""
+        if flat.dtype.kind == 'b':
+            flat = flat.astype(np.uint8)
+        if flat.dtype.kind in 'iu' and flat.size:
+            if flat.dtype.kind == 'i' and flat.dtype.itemsize < 4:
+                flat = flat.astype(np.int32)  # room for the offsets below
+            low, high = flat.min(), flat.max()
+            if int(high) - int(low) < _TABLE_LIMIT:
+                table = np.array(
+                    [self.number(v) for v in range(int(low), int(high) + 1)],
+                    dtype=object)
+                return iter(table[flat - low])
+        if flat.dtype.kind in 'iuf':
+            if self.plain:
+                return iter(flat.astype(str))
+            return map(self.number, flat)
+        return map(self, flat)
+
+    def buffer(self, buf):
+        """format a flat memoryview"""
+        if buf.format in ('c', '?'):
+            buf = buf.cast('B')
+        if buf.format == 'B':
+            if self.ints is not None:
+                return map(self.ints.__getitem__, buf)
+            return map(self.number, buf)
+        return map(self, buf)
+
+
+@lru_cache(maxsize=32)
+def _shared_formatter(value_opts):
+    return _Formatter(value_opts)
+
+
+def _formatter(value_opts=None):
+    """formatter for value_opts, shared between Variables using the same"""
+    try:
+        return _shared_formatter(value_opts)
+    except TypeError:  # unhashable callable
+        return _Formatter(value_opts)
+
+
+def _flatten_buffer(buf, formatter):
+    """return the dimensions and an iterator of formatted elements"""
+    if np is not None and isinstance(buf, np.ndarray):
+        return list(buf.shape), formatter.ndarray(buf.reshape(-1))
+    if not isinstance(buf, memoryview):
+        buf = memoryview(buf)
+    dims = list(buf.shape)
+    if buf.ndim != 1:
+        if not buf.c_contiguous:
+            buf = memoryview(buf.tobytes())
+        buf = buf.cast('B').cast(buf.format)
+    return dims, formatter.buffer(buf)
+
+
+def _emit_shaped(append, texts, dims, depth, indent, lf):
+    """print already formatted elements as an array of the given dimensions"""
+    if len(dims) == 1:
+        row = list(islice(texts, dims[0]))
+        if len(row) < dims[0]:
+            raise ValueError('array value has fewer elements than its shape')
+        append('{' + ', '.join(row) + '}')
+        return
+    newline = lf + indent * (depth + 1)
+    append('{')
+    for i in range(dims[0]):
+        append(',' + newline if i else newline)
+        _emit_shaped(append, texts, dims[1:], depth + 1, indent, lf)
+    if dims[0]:
+        append(lf + indent * depth)
+    append('}')
+
+
+def _format_lazy(items, formatter, size):
+    """format values from an iterator, taking size values at a time"""
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        texts = formatter.row(chunk)
+        if texts is None:
+            texts = map(formatter, chunk)
+        yield from texts
+
+
+def _emit_buffer(append, buf, depth, indent, lf, formatter):
+    """print an ndarray or buffer without converting it to lists"""
+    dims, texts = _flatten_buffer(buf, formatter)
+    if dims:
+        _emit_shaped(append, texts, dims, depth, indent, lf)
+    else:
+        append(next(texts))
+
+
+def _emit_array(append, array, depth, indent, lf, formatter):
+    """print a (multi)dimensional array or struct as a braced initializer
+
+    Output is passed to append piecewise: flat rows of numbers are joined in
+    one go, nested values are printed recursively one level deeper. Lines
+    are separated by lf, which may carry the indentation of the whole block.
+    """
+    if isinstance(array, _BUFFERS):
+        _emit_buffer(append, array, depth, indent, lf, formatter)
+        return
+
+    newline = lf + indent * (depth + 1)
+    # what was printed last: nothing yet, a single value or a braced value
+    start, single, braced = 0, 1, 2
+    last = start
+
+    append('{')
+    if isinstance(array, dict):
+        for key, value in array.items():
+            if last == single:
+                append(', ')
+            elif last == braced:
+                append(',')
+            append(newline + '.' + key + ' = ')
+            if isinstance(value, _ARRAYS):
+                _emit_array(append, value, depth + 1, indent, lf, formatter)
+                last = braced
+            else:
+                append(formatter(value))
+                last = single
+    else:
+        row = formatter.row(array)
+        if row is not None:
+            append(', '.join(row))
+            append('}')
+            return
+        for value in array:
+            if isinstance(value, _ARRAYS):
+                if last == single:
+                    append(', ')
+                elif last == braced:
+                    append(',' + newline)
+                else:
+                    append(newline)
+                _emit_array(append, value, depth + 1, indent, lf, formatter)
+                last = braced
+            else:
+                if last == single:
+                    append(', ')
+                elif last == braced:
+                    append(',' + newline)
+                append(formatter(value))
+                last = single
+    if last == braced:
+        append(lf + indent * depth)
+    append('}')
+
+
+def _as_list(array):
+    """elements of a list, tuple, ndarray or buffer"""
+    if np is not None and isinstance(array, np.ndarray):
+        return array.tolist()
+    if isinstance(array, _BUFFERS):
+        return memoryview(array).tolist()
+    return array
+
+
+def _is_zero(value):
+    """whether a value is all zeros, and can be left out of an initializer"""
+    if isinstance(value, dict):
+        return all(map(_is_zero, value.values()))
+    if isinstance(value, _ARRAYS):
+        return all(map(_is_zero, _as_list(value)))
+    if isinstance(value, float):
+        # -0.0 has to be written out, as it differs from the implicit 0.0
+        return value == 0 and math.copysign(1.0, value) > 0
+    return isinstance(value, int) and value == 0
+
+
+def _run_key(value):
+    if isinstance(value, float):
+        # -0.0 == 0.0, but the two must not be merged into a single run
+        return float, value, math.copysign(1.0, value)
+    return type(value), value
+
+
+def _lazy_elements(items, dims):
+    """elements along the first dimension of a lazy value, as nested lists"""
+    size = 1
+    for dim in dims[1:]:
+        size *= dim
+    for _ in range(dims[0]):
+        flat = list(islice(items, size))
+        if len(flat) < size:
+            raise ValueError('array value has fewer elements than its shape')
+        if len(dims) == 1:
+            yield flat[0]
+            continue
+        for dim in reversed(dims[2:]):
+            flat = [flat[i:i + dim] for i in range(0, len(flat), dim)]
+        yield flat
+
+
+def _emit_compressed(append, elements, depth, indent, lf, formatter, ranges):
+    """print an array leaving out zeros, with designators for the rest
+
+    Elements following each other are printed after a single [index] = (a
+    C99 designator). With ranges, runs of equal elements are printed as
+    [first ... last] = value (a GNU extension). Like in _emit_array, numbers
+    share a line and nested arrays get one line each.
+    """
+    newline = lf + indent * (depth + 1)
+    # what was printed last: nothing yet, a single value or a braced value
+    start, single, braced = 0, 1, 2
+    last = start
+    index = 0
+    resume = 0  # index of the element following the last printed one
+
+    append('{')
+    for _, run in groupby(elements, _run_key):
+        value = next(run)
+        length = 1 + sum(1 for _ in run)
+        if _is_zero(value):
+            index += length
+            continue
+        if ranges and length >= _MIN_RANGE:
+            head = '[{0} ... {1}] = '.format(index, index + length - 1)
+            count = 1  # printed once for the whole range
+        else:
+            head = '' if index == resume else '[{0}] = '.format(index)
+            count = length
+            resume = index + length
+        index += length
+
+        if isinstance(value, _ARRAYS):
+            for _ in range(count):
+                append(',' + newline if last else newline)
+                append(head)
+                head = ''
+                if isinstance(value, dict):
+                    _emit_array(append, value, depth + 1, indent, lf,
+                                formatter)
+                else:
+                    _emit_compressed(append, _as_list(value), depth + 1,
+                                     indent, lf, formatter, ranges)
+                last = braced
+        else:
+            if last == single:
+                append(', ')
+            elif last == braced:
+                append(',' + newline)
+            text = formatter(value)
+            append(head + (text if count == 1 else ', '.join([text] * count)))
+            last = single
+
+    if last == start:
+        append('0}')
+    elif last == braced:
+        append(lf + indent * depth + '}')
+    else:
+        append('}')
+
+
+def _is_binary_sink(sink):
+    """guess whether a writable object expects bytes rather than str"""
+    if isinstance(sink, io.TextIOBase):
+        return False
+    if isinstance(sink, (io.RawIOBase, io.BufferedIOBase)):
+        return True
+    return 'b' in getattr(sink, 'mode', '')
+
+
+@lru_cache(maxsize=None)
+def _file_mode():
+    """permissions of a newly created file, as open() would set them"""
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+def _text_digest(chunks):
+    """digest of text as it ends up on disk when written in text mode"""
+    digest = hashlib.sha256()
+    for chunk in chunks:
+        if os.linesep != '\n':
+            chunk = chunk.replace('\n', os.linesep)
+        digest.update(chunk.encode('utf-8', 'surrogatepass'))
+    return digest.hexdigest()
+
+
+def _text_opener(compression=None, encoding=None):
+    """open() for plain or compressed (gzip, xz or zstd) text files"""
+    if compression is None:
+        opener = open
+    elif compression == 'gzip':
+        opener = gzip.open
+    elif compression == 'xz':
+        opener = lzma.open
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise ImportError('zstd compression needs the zstandard package')
+        opener = zstandard.open
+    else:
+        raise ValueError('unknown compression "{0}"'.format(compression))
+    return partial(opener, encoding=encoding)
+
+
+def _file_digest(file, opener=open):
+    """digest of an existing text file (None if it cannot be read)"""
+    try:
+        with opener(file, 'rt', newline='') as the_file:
+            return _text_digest(iter(lambda: the_file.read(1 << 20), ''))
+    except (OSError, EOFError, UnicodeDecodeError):
+        return None
+
+
+def _write_atomically(file, chunks, opener=open):
+    """write text to a temporary file and move it over file in one step"""
+    directory, name = os.path.split(os.path.abspath(file))
+    handle, temp = tempfile.mkstemp(
+        prefix='.' + name + '.', suffix='.tmp', dir=directory)
+    os.close(handle)
+    try:
+        with opener(temp, 'wt') as the_file:
+            the_file.writelines(chunks)
+        os.chmod(temp, _file_mode())
+        os.replace(temp, file)
+    except BaseException:
+        os.unlink(temp)
+        raise
+
+
+def _slot_state(obj):
+    """attributes of an object stored in __slots__, for pickling"""
+    return {
+        name: getattr(obj, name)
+        for cls in type(obj).__mro__
+        for name in getattr(cls, '__slots__', ())
+        if hasattr(obj, name)
+    }
+
+
+_stamps = count(1)  # stamps of edits, new objects start out with 0
+_stamp_of = attrgetter('_stamp')
+
+
+def _stamped(slot):
+    """property kept in slot, which stamps its object when assigned
+
+    Code cached from objects stays valid while the same objects have the
+    same stamps, so that edits made in place are noticed without rendering
+    again.
+    """
+    def assign(obj, value):
+        setattr(obj, slot, value)
+        obj._stamp = next(_stamps)
+    return property(attrgetter(slot), assign)
+
+
+def _stamped_state(obj):
+    """pickled state of an object with stamped attributes, without stamp"""
+    state = _slot_state(obj)
+    state.pop('_stamp', None)
+    return None, state
+
+
+def _restore_stamped(obj, state):
+    """unpickle an object with stamped attributes"""
+    for name, value in state[1].items():
+        setattr(obj, name, value)
+    obj._stamp = 0
+
+
+class _CommentedLine:
+    """passes text on, with a trailing comment at the end of its first line"""
+
+    def __init__(self, append, comment, lf):
+        self.append = append
+        self.comment = ' //' + comment
+        self.lf = lf
+
+    def __call__(self, text):
+        if self.comment is not None:
+            pos = text.find(self.lf)
+            if pos >= 0:
+                text = text[:pos] + self.comment + text[pos:]
+                self.comment = None
+        self.append(text)
+
+    def finish(self):
+        """add the comment if the text had a single line"""
+        if self.comment is not None:
+            self.append(self.comment)
+            self.comment = None
 
 
 # classes defining C constructs
@@ -25,15 +605,27 @@ def shape(array):
 class EnumValue:
     """Singular value of an C-style enumeration"""
 
+    __slots__ = ('_name', '_value', '_comment', '_stamp')
+
+    name = _stamped('_name')
+    value = _stamped('_value')
+    comment = _stamped('_comment')
+
     def __init__(self, name, value=None, comment=None):
-        self.name = name
-        self.value = value
-        self.comment = comment
+        self._name = name
+        self._value = value
+        self._comment = comment
+        self._stamp = 0
+
+    __getstate__ = _stamped_state
+    __setstate__ = _restore_stamped
 
 
 class Enum:
     """c-style enumeration class"""
 
+    __slots__ = ('values', 'name', 'prefix', '_rendered')
+
     def __init__(self, name, prefix=""):
 
         # enum values
@@ -41,15 +633,43 @@ class Enum:
         self.name = name
 
         self.prefix = prefix
+        self._rendered = {}  # code of the enum per writer layout
+
+    def __getstate__(self):
+        state = _slot_state(self)
+        state['_rendered'] = {}  # caches are not part of the state
+        return None, state
 
     def add_value(self, name, value=None, comment=None):
         """assures that the user adds the values in the correct order"""
 
         self.values.append(EnumValue(name, value=value, comment=comment))
+        self._rendered.clear()
+
+    def _signature(self):
+        """name, prefix, values and their stamps, which the code depends on"""
+        return (self.name, self.prefix, list(self.values),
+                list(map(_stamp_of, self.values)))
 
 
 class Variable:
-    """c-style variable"""
+    """c-style variable
+
+    Array initializers can be compressed: 'sparse' leaves out zeros and
+    designates the index of the remaining elements, 'ranges' additionally
+    prints runs of equal elements as a range (a GNU extension).
+    """
+
+    __slots__ = ('_name', '_primitive', '_comment', '_array', '_qualifiers',
+                 'validate', '_value', '_shape', '_auto', 'value_opts',
+                 'compress', '_stamp')
+
+    name = _stamped('_name')
+    comment = _stamped('_comment')
+    array = _stamped('_array')
+    qualifiers = _stamped('_qualifiers')
+
+    COMPRESSIONS = ('sparse', 'ranges')
 
     def __init__(self,
                  name,
@@ -58,14 +678,93 @@ class Variable:
                  array=None,
                  comment=None,
                  value=None,
-                 value_opts=None):
-        self.name = name
-        self.primitive = primitive
-        self.comment = comment
-        self.array = array
-        self.qualifiers = qualifiers
+                 value_opts=None,
+                 validate=False,
+                 compress=None):
+        if compress is not None and compress not in self.COMPRESSIONS:
+            raise ValueError('compress must be one of {0}'.format(
+                ', '.join(self.COMPRESSIONS)))
+        self._name = name
+        self._primitive = primitive
+        self._comment = comment
+        self._array = array
+        self._qualifiers = qualifiers
+        self.validate = validate  # check values for ragged arrays
         self.value = value
-        self.value_opts = value_opts
+        self._stamp = 0
+        self.value_opts = value_opts  # format string or callable for numbers
+        self.compress = compress  # None, 'sparse' or 'ranges'
+
+    @property
+    def primitive(self):
+        """type of the variable
+
+        'auto' stands for the narrowest stdint.h type holding the (integer)
+        value, which declaration and initialization both use.
+        """
+        if self._primitive != 'auto':
+            return self._primitive
+        if self._auto is None:
+            if isinstance(self._value, Iterator):
+                raise ValueError(
+                    'primitive "auto" needs a value that is not lazy for '
+                    'Variable "{name}"'.format(name=self.name))
+            try:
+                self._auto = narrowest_type(self._value)
+            except TypeError:
+                raise ValueError(
+                    'primitive "auto" needs integer values for Variable '
+                    '"{name}"'.format(name=self.name)) from None
+        return self._auto
+
+    @primitive.setter
+    def primitive(self, primitive):
+        self._primitive = primitive
+        self._auto = None
+        self._stamp = next(_stamps)
+
+    @property
+    def value(self):
+        """initial value of the variable"""
+        return self._value
+
+    @value.setter
+    def value(self, value):
+        self._value = value
+        self._shape = None
+        self._auto = None
+        self._stamp = next(_stamps)  # array dimensions may come from value
+        if self.validate or isinstance(value, Iterator):
+            self.value_shape()
+
+    def __getstate__(self):
+        state = _stamped_state(self)[1]
+        state['_shape'] = None  # caches are not part of the state
+        state['_auto'] = None
+        return None, state
+
+    __setstate__ = _restore_stamped
+
+    def value_shape(self):
+        """Return the shape of value, cached until value is reassigned.
+
+        Lazy values (iterators) take their shape from the array dimensions.
+        """
+        if self._shape is None:
+            if isinstance(self._value, Iterator):
+                self._shape = self.__declared_shape()
+            else:
+                self._shape = shape(self._value, validate=self.validate)
+        return self._shape
+
+    def __declared_shape(self):
+        if self.array is None:
+            raise ValueError(
+                'no array dimensions supplied for the lazy value of '
+                'Variable "{name}"'.format(name=self.name))
+        if isinstance(self.array, (tuple, list)):
+            return [int(dim) for dim in self.array]
+        return [int(self.array)]
 
     def __array_dimensions(self):
         if isinstance(self.array, (tuple, list)):
@@ -74,146 +773,315 @@ class Variable:
             array = "[{dim}]".format(dim=str(self.array))
         elif self.array is None and isinstance(self.value, str):
             array = '[]'
-        elif self.array is None and shape(self.value):
-            array = "".join("[{0}]".format(dim) for dim in shape(self.value))
+        elif self.array is None and self.value_shape():
+            array = "".join("[{0}]".format(dim) for dim in self.value_shape())
         else:
             array = ""
         return array
 
     def declaration(self, extern=False):
         """Return a declaration string."""
-        if isinstance(self.qualifiers, (list, tuple)):
-            qual = " ".join(self.qualifiers) + " "
-        elif self.qualifiers is not None:
-            qual = str(self.qualifiers) + " "
-        else:
-            qual = ""
-
-        array = self.__array_dimensions()
         return '{ext}{qual}{prim} {name}{array}'.format(
             ext='extern ' if extern else '',
-            qual=qual,
+            qual=_qualifiers(self),
             prim=self.primitive,
             name=self.name,
-            array=array)
+            array=self.__array_dimensions())
 
     def initialization(self, indent='    '):
         """Return an initialization string."""
-
-        def generate_single_var(var_, formatstring=None):
-            """generate single variable"""
-            if isinstance(var_, str):
-                return "\"{val}\"".format(val=var_)
-            elif isinstance(var_, (int, float)):
-                if formatstring is None:
-                    return str(var_)
-                return formatstring.format(var_)
-
-        def generate_array(array, indent='    ', formatstring=None):
-            """print (multi)dimensional arrays"""
-
-            class OpenBrace:
-                """Helper class to identify open braces while printing."""
-                pass
-
-            class ClosedBrace:
-                """Helper class to identify closed braces while printing"""
-                pass
-
-            class Designator:
-                """Helper class to identify struct designators"""
-                def __init__(self, name):
-                    self.name = name
-
-            depth = 0
-            stack = []
-            stack.append(array)
-            output = ''
-            leading_comma = False
-
-            while stack:
-                top = stack.pop()
-                # non-printed tokens
-                if isinstance(top, (list, tuple)):
-                    stack.append(ClosedBrace())
-                    stack.extend(top[::-1])
-                    stack.append(OpenBrace())
-                    continue
-                if isinstance(top, dict):
-                    stack.append(ClosedBrace())
-                    dict_pairs = [[value, Designator(key)] for key, value in top.items()][::-1]
-                    flatdict = [item for sublist in dict_pairs for item in sublist]
-                    stack.extend(flatdict)
-                    stack.append(OpenBrace())
-                    continue
-                # non-comma-delimited tokens
-                if isinstance(top, ClosedBrace):
-                    depth -= 1 if depth > 0 else 0
-                    output += '}'
-                    if stack:
-                        if isinstance(stack[-1], ClosedBrace):
-                            output += '\n' + (indent * (depth - 1))
-                        elif isinstance(stack[-1], Designator):
-                            output += ','
-                        else:
-                            output += ',\n' + (indent * depth)
-                        leading_comma = False
-                    continue
-                # check the need for leading comma
-                if leading_comma:
-                    output += ', '
-                else:
-                    leading_comma = True
-                # (potentially) comma delimited tokens
-                if isinstance(top, OpenBrace):
-                    output += '{'
-                    depth += 1
-                    if isinstance(stack[-1], (OpenBrace, list, tuple, dict)):
-                        output += '\n' + (indent * depth)
-                    leading_comma = False
-                    continue
-                if isinstance(top, (int, float, str)):
-                    output += generate_single_var(top, formatstring)
-                    continue
-                if isinstance(top, Designator):
-                    output += '\n' + (indent * depth)
-                    output += '.' + top.name + ' = '
-                    leading_comma = False
-                    continue
-            return output
-
-        # main part: generating initializer
-        if isinstance(self.qualifiers, (list, tuple)):
-            qual = " ".join(self.qualifiers) + " "
-        elif self.qualifiers is not None:
-            qual = str(self.qualifiers) + " "
+        parts = []
+        self.emit_initialization(parts.append, indent)
+        return ''.join(parts)
+
+    def emit_initialization(self, append, indent='    ', lf='\n'):
+        """Pass the initialization to append piece by piece.
+
+        Lines are separated by lf, which may include the indentation of all
+        lines after the first.
+        """
+        append('{qual}{prim} {name}{array} = '.format(
+            qual=_qualifiers(self),
+            prim=self.primitive,
+            name=self.name,
+            array=self.__array_dimensions()))
+
+        formatter = _formatter(self.value_opts)
+        lazy = isinstance(self.value, Iterator)
+        if self.compress is not None and (
+                lazy or isinstance(self.value, _SEQUENCES)):
+            dims = self.value_shape()
+            if len(dims) > 1:
+                append(lf)
+            if lazy:
+                elements = _lazy_elements(self.value, dims)
+            else:
+                elements = _as_list(self.value)
+            _emit_compressed(append, elements, 0, indent, lf, formatter,
+                             self.compress == 'ranges')
+        elif isinstance(self.value, _ARRAYS):
+            if len(self.value_shape()) > 1:
+                append(lf)
+            _emit_array(append, self.value, 0, indent, lf, formatter)
+        elif lazy:
+            # lazy values are formatted row by row in a single pass
+            dims = self.value_shape()
+            if len(dims) > 1:
+                append(lf)
+            texts = _format_lazy(self.value, formatter, dims[-1] or 1)
+            _emit_shaped(append, texts, dims, 0, indent, lf)
         else:
-            qual = ""
+            append(formatter(self.value))
+        if lazy and next(self.value, _END) is not _END:
+            raise ValueError(
+                'lazy value of Variable "{name}" has more elements than '
+                'its array dimensions'.format(name=self.name))
+        append(';')
+
+
+def _qualifiers(var):
+    """qualifiers of a Variable as the start of its declaration, e.g.
+    'static const ' (an empty string without qualifiers)"""
+    if isinstance(var.qualifiers, (list, tuple)):
+        return " ".join(var.qualifiers) + " "
+    elif var.qualifiers is not None:
+        return str(var.qualifiers) + " "
+    return ""
+
+
+def _dimensions(var):
+    """array dimensions of a Variable, declared or else of its value"""
+    if isinstance(var.array, (tuple, list)):
+        return list(var.array)
+    if var.array is not None:
+        return [var.array]
+    if isinstance(var.value, _SEQUENCES):
+        return var.value_shape()
+    return []
+
+
+def _render_initializations(variables, indent, lf, tabs, commenting):
+    """code of CodeWriter.add_variable_initializations, for an executor"""
+    writer = CodeWriter(lf=lf, indent=indent)
+    writer.tabs = tabs
+    writer.commenting = commenting
+    writer.add_variable_initializations(variables)
+    return writer.text
+
+
+def _hex_rows(block, step, prefix, sep):
+    """rows of step bytes in two-digit hex, via bytes.hex"""
+    text = block.hex(' ')
+    width = 3 * step
+    return [
+        prefix + text[i:i + width - 1].replace(' ', sep)
+        for i in range(0, len(text), width)
+    ]
+
+
+def _table_rows(block, step, table, sep):
+    """rows of step bytes, formatted through a table of all byte values"""
+    items = list(map(table.__getitem__, block))
+    return [sep.join(items[i:i + step]) for i in range(0, len(items), step)]
+
+
+@contextmanager
+def _blob_data(source):
+    """bytes of a file (memory mapped) or buffer, as a memoryview"""
+    if not isinstance(source, (str, os.PathLike)):
+        with memoryview(source) as data:
+            yield data.cast('B')
+        return
+    with open(source, 'rb') as the_file:
+        if not os.fstat(the_file.fileno()).st_size:
+            yield memoryview(b'')
+            return
+        with mmap.mmap(the_file.fileno(), 0, access=mmap.ACCESS_READ) as mem:
+            with memoryview(mem) as data:
+                yield data
 
-        array = self.__array_dimensions()
 
-        if isinstance(self.value, (tuple, list, dict)):
-            assignment = '\n' if len(shape(self.value)) > 1 else ''
-            assignment += generate_array(self.value, indent, self.value_opts)
-        else:
-            assignment = generate_single_var(self.value, self.value_opts)
+class Blob(Variable):
+    """c-style byte array holding the contents of a file or buffer
 
-        return '{qual}{prim} {name}{array} = {assignment};'.format(
-            qual=qual,
-            prim=self.primitive,
+    Files are memory mapped rather than read into Python objects. style
+    selects the initializer: 'array' (rows of row_length formatted bytes),
+    'string' (rows of string literal escapes, which compilers parse faster)
+    or 'embed' (a C23 #embed directive for the file, see embed_path).
+    """
+
+    __slots__ = ('source', 'row_length', 'style', 'embed_path', '_digest')
+
+    STYLES = ('array', 'string', 'embed')
+
+    def __init__(self,
+                 name,
+                 source,
+                 primitive='uint8_t',
+                 qualifiers='const',
+                 comment=None,
+                 value_opts='0x{0:02x}',
+                 row_length=16,
+                 style='array',
+                 embed_path=None):
+        super().__init__(name, primitive, qualifiers=qualifiers,
+                         comment=comment, value_opts=value_opts)
+        if style not in self.STYLES:
+            raise ValueError('style must be one of {styles}'.format(
+                styles=', '.join(self.STYLES)))
+        if style == 'embed' and not isinstance(source, (str, os.PathLike)):
+            raise ValueError('embed style requires a file as source')
+        self.source = source  # file name or bytes-like object
+        self.row_length = row_length
+        self.style = style
+        self.embed_path = embed_path  # path as seen by the compiler
+        self._digest = None
+
+    def __getstate__(self):
+        state = _stamped_state(self)[1]
+        state['_shape'] = None
+        state['_auto'] = None
+        # fingerprints should follow changes to the contents of the source
+        with _blob_data(self.source) as data:
+            state['_digest'] = hashlib.sha256(data).hexdigest()
+        return None, state
+
+    def size(self):
+        """Return the number of bytes in the blob."""
+        if isinstance(self.source, (str, os.PathLike)):
+            return os.path.getsize(self.source)
+        with memoryview(self.source) as data:
+            return data.nbytes
+
+    def value_shape(self):
+        """Return the shape of the blob, i.e. its size."""
+        return [self.size()]
+
+    def emit_initialization(self, append, indent='    ', lf='\n'):
+        """Pass the initialization to append piece by piece."""
+        append(self.declaration() + ' = ' + lf)
+        if self.style == 'embed':
+            append('{{{lf}{ind}#embed "{path}"{lf}}};'.format(
+                lf=lf,
+                ind=indent,
+                path=self.embed_path or os.fspath(self.source)))
+            return
+
+        if self.style == 'string':
+            rows = partial(_hex_rows, prefix='\\x', sep='\\x')
+            sep = '"' + lf + '"'
+            append('"')
+        else:
+            if self.value_opts == '0x{0:02x}':
+                rows = partial(_hex_rows, prefix='0x', sep=', 0x')
+            else:
+                number = _formatter(self.value_opts).number
+                table = tuple(number(byte) for byte in range(256))
+                rows = partial(_table_rows, table=table, sep=', ')
+            sep = ',' + lf + indent
+            append('{' + lf + indent)
+
+        chunk = self.row_length * 1024  # bytes formatted per piece of output
+        with _blob_data(self.source) as data:
+            if not len(data):
+                raise ValueError('Blob "{name}" is empty'.format(
+                    name=self.name))
+            for start in range(0, len(data), chunk):
+                if start:
+                    append(sep)
+                with data[start:start + chunk] as block:
+                    append(sep.join(rows(block, self.row_length)))
+        append('";' if self.style == 'string' else lf + '};')
+
+
+class StructLayout:
+    """offsets and sizes of a Struct's members, see Struct.layout"""
+
+    def __init__(self, name, members, size, alignment):
+        self.name = name
+        self.members = members  # (name, offset, size) in declaration order
+        self.size = size  # sizeof the struct, including tail padding
+        self.alignment = alignment
+
+    @property
+    def padding(self):
+        """bytes lost to alignment"""
+        return self.size - sum(size for _, _, size in self.members)
+
+    def report(self):
+        """Return the layout as a table."""
+        rows = ['{0}: {1} bytes, {2} bytes padding'.format(
+            self.name, self.size, self.padding)]
+        rows.append('{0:>8}{1:>8}  {2}'.format('offset', 'size', 'member'))
+        for name, offset, size in self.members:
+            rows.append('{0:>8}{1:>8}  {2}'.format(offset, size, name))
+        return '\n'.join(rows)
+
+    def __repr__(self):
+        return '{cls}({name!r}, size={size}, padding={padding})'.format(
+            cls=type(self).__name__,
             name=self.name,
-            array=array,
-            assignment=assignment)
+            size=self.size,
+            padding=self.padding)
 
 
 class Struct:
     """c-style struct class"""
 
+    __slots__ = ('_name', '_ref_name', 'variables', '_comment', '_rendered',
+                 '_stamp')
+
+    name = _stamped('_name')
+    ref_name = _stamped('_ref_name')
+    comment = _stamped('_comment')
+
+    # (size, alignment) of primitives on common 64-bit targets; pass a table
+    # of your own to layout() for other targets or further types
+    LAYOUT = {
+        'char': (1, 1),
+        'signed char': (1, 1),
+        'unsigned char': (1, 1),
+        'bool': (1, 1),
+        '_Bool': (1, 1),
+        'int8_t': (1, 1),
+        'uint8_t': (1, 1),
+        'short': (2, 2),
+        'unsigned short': (2, 2),
+        'int16_t': (2, 2),
+        'uint16_t': (2, 2),
+        'int': (4, 4),
+        'unsigned': (4, 4),
+        'unsigned int': (4, 4),
+        'int32_t': (4, 4),
+        'uint32_t': (4, 4),
+        'float': (4, 4),
+        'long': (8, 8),
+        'unsigned long': (8, 8),
+        'long long': (8, 8),
+        'unsigned long long': (8, 8),
+        'int64_t': (8, 8),
+        'uint64_t': (8, 8),
+        'double': (8, 8),
+        'size_t': (8, 8),
+        'intptr_t': (8, 8),
+        'uintptr_t': (8, 8),
+        'void *': (8, 8),  # any pointer
+    }
+
     def __init__(self, name, ref_name=None, comment=None):
-        self.name = name  # definition name of this struct e.g. Struct_t
-        self.ref_name = ref_name  # reference name of this struct e.g. the_struct
+        self._name = name  # definition name of this struct e.g. Struct_t
+        self._ref_name = ref_name  # reference name of this struct e.g. the_struct
         self.variables = []
-        self.comment = comment
+        self._comment = comment
+        self._rendered = {}  # code of the struct per writer layout
+        self._stamp = 0
+
+    def __getstate__(self):
+        state = _stamped_state(self)[1]
+        state['_rendered'] = {}  # caches are not part of the state
+        return None, state
+
+    __setstate__ = _restore_stamped
 
     def add_variable(self, variable):
         """Add another variable to struct"""
@@ -221,6 +1089,12 @@ class Struct:
             raise TypeError("variable must be 'Variable' or 'Struct'")
 
         self.variables.append(variable)
+        self._rendered.clear()
+
+    def _signature(self):
+        """stamp, members and their stamps, which the code depends on"""
+        return (self._stamp, list(self.variables),
+                list(map(_stamp_of, self.variables)))
 
     def declaration(self):
         """Return a declaration string."""
@@ -230,15 +1104,106 @@ class Struct:
 
         return '{name} {ref};'.format(name=self.name, ref=self.ref_name)
 
+    def __member_layout(self, var, types):
+        """name, size and alignment of a member"""
+        if isinstance(var, Struct):
+            inner = var.layout(types)
+            return var.ref_name, inner.size, inner.alignment
+
+        primitive = ' '.join(var.primitive.split())
+        if '*' in primitive:
+            primitive = 'void *'
+        layout = types.get(primitive)
+        if layout is None:
+            # e.g. the name of a typedef in 'struct Other_t'
+            layout = types.get(primitive.split()[-1])
+        if layout is None:
+            raise ValueError(
+                'unknown size of "{prim}" for member "{var}" of Struct '
+                '"{name}"'.format(prim=var.primitive, var=var.name,
+                                  name=self.name))
+        size, alignment = layout
+        for dim in _dimensions(var):
+            size *= int(dim)
+        return var.name, size, alignment
+
+    def layout(self, types=None):
+        """Return the StructLayout of the members in their current order.
+
+        types maps primitives to (size, alignment), by default LAYOUT.
+        Nested structs are laid out with the same table.
+        """
+        types = self.LAYOUT if types is None else types
+        members = []
+        offset = 0
+        alignment = 1
+        for var in self.variables:
+            name, size, align = self.__member_layout(var, types)
+            offset = -(-offset // align) * align
+            members.append((name, offset, size))
+            offset += size
+            alignment = max(alignment, align)
+        size = -(-offset // alignment) * alignment
+        return StructLayout(self.name, members, size, alignment)
+
+    def optimize_layout(self, types=None):
+        """reorder the members to minimize padding
+
+        Members are sorted by decreasing alignment, which leaves padding only
+        at the end; members of equal alignment keep their order. Returns the
+        StructLayouts before and after. Initializers of the struct written
+        as dicts can be put into the new order with order_initializer.
+        """
+        types = self.LAYOUT if types is None else types
+        before = self.layout(types)
+        alignments = [self.__member_layout(var, types)[2]
+                      for var in self.variables]
+        order = sorted(range(len(self.variables)),
+                       key=lambda i: -alignments[i])
+        self.variables = [self.variables[i] for i in order]
+        self._rendered.clear()
+        return before, self.layout(types)
+
+    def order_initializer(self, value):
+        """Return a designated initializer (dict) in member order.
+
+        value may also be a (nested) list of dicts, e.g. the value of an
+        array of structs. Values of nested struct members are ordered as
+        well; keys that are no members are kept, at the end.
+        """
+        if isinstance(value, (list, tuple)):
+            return [self.order_initializer(item) for item in value]
+        if not isinstance(value, dict):
+            return value
+        ordered = {}
+        for var in self.variables:
+            name = var.ref_name if isinstance(var, Struct) else var.name
+            if name in value:
+                item = value[name]
+                if isinstance(var, Struct):
+                    item = var.order_initializer(item)
+                ordered[name] = item
+        for name, item in value.items():
+            ordered.setdefault(name, item)
+        return ordered
+
 
 class Function:
     """c-style function"""
 
+    __slots__ = ('name', 'return_type', 'variables', '_prototype')
+
     def __init__(self, name, return_type='void'):
         self.name = name
         self.return_type = return_type
 
         self.variables = []
+        self._prototype = None  # (name, return type, arguments, stamps, text)
+
+    def __getstate__(self):
+        state = _slot_state(self)
+        state['_prototype'] = None  # caches are not part of the state
+        return None, state
 
     def add_argument(self, var):
         """Add an argument to function"""
@@ -246,15 +1211,25 @@ class Function:
             raise TypeError("variable must be of type 'Variable'")
 
         self.variables.append(var)
+        self._prototype = None
 
     def prototype(self):
-        """function prototype string"""
+        """function prototype string (cached until the function or one of
+        its arguments changes)"""
+        stamps = list(map(_stamp_of, self.variables))
+        cached = self._prototype
+        if cached is not None and cached[:4] == (
+                self.name, self.return_type, self.variables, stamps):
+            return cached[4]
+
         prot = '{ret} {nm}({funcs})'.format(
             ret=self.return_type,
             nm=self.name,
             funcs=', '.join([v.declaration() for v in self.variables])
             if self.variables else 'void')
 
+        self._prototype = (self.name, self.return_type, list(self.variables),
+                           stamps, prot)
         return prot
 
     def call(self, *arg):
@@ -270,6 +1245,204 @@ class Function:
         return call_
 
 
+class Dispatch:
+    """c function looking up an integer key in a table of cases
+
+    cases maps integer keys to C expressions of value_type: numbers, or the
+    names of handler functions when value_type is a function pointer type.
+    Keys without a case give default. strategy selects the code: 'table'
+    (an array indexed by the key), 'search' (a binary search of the sorted
+    keys), 'switch', or 'auto' to pick one by how dense the keys are.
+    """
+
+    __slots__ = ('name', 'cases', 'key_type', 'value_type', 'default',
+                 'strategy')
+
+    STRATEGIES = ('auto', 'table', 'search', 'switch')
+    MAX_SWITCH = 8  # cases left to the compiler as a plain switch
+    MIN_DENSITY = 0.5  # fraction of the key range with cases for a table
+
+    def __init__(self,
+                 name,
+                 cases,
+                 key_type='int',
+                 value_type='int',
+                 default=0,
+                 strategy='auto'):
+        if strategy not in self.STRATEGIES:
+            raise ValueError('strategy must be one of {0}'.format(
+                ', '.join(self.STRATEGIES)))
+        self.name = name
+        self.cases = dict(cases)
+        if not all(isinstance(key, int) for key in self.cases):
+            raise TypeError('case keys must be integers')
+        self.key_type = key_type
+        self.value_type = value_type
+        self.default = default
+        self.strategy = strategy
+
+    def function(self):
+        """Return the lookup Function, e.g. for its prototype."""
+        func = Function(self.name, self.value_type)
+        func.add_argument(Variable('key', self.key_type))
+        return func
+
+    def choose_strategy(self):
+        """Return the strategy used for the code."""
+        if self.strategy != 'auto':
+            return self.strategy
+        if len(self.cases) <= self.MAX_SWITCH:
+            return 'switch'
+        span = max(self.cases) - min(self.cases) + 1
+        if len(self.cases) >= self.MIN_DENSITY * span:
+            return 'table'
+        return 'search'
+
+
+# instrumentation of CodeWriters
+
+class WriterStats:
+    """characters, lines, calls and seconds spent per kind of construct
+
+    Filled in by CodeWriters created with stats=. One instance can be shared
+    by several writers to sum up a whole generation run. Characters equal
+    bytes for ASCII code.
+    """
+
+    def __init__(self):
+        self.chars = {}
+        self.lines = {}
+        self.calls = {}
+        self.seconds = {}
+
+    def record(self, kind, seconds, chars=0, lines=0):
+        """add a call emitting a construct of this kind"""
+        self.calls[kind] = self.calls.get(kind, 0) + 1
+        self.seconds[kind] = self.seconds.get(kind, 0.0) + seconds
+        self.chars[kind] = self.chars.get(kind, 0) + chars
+        self.lines[kind] = self.lines.get(kind, 0) + lines
+
+    def report(self):
+        """Return the statistics as a table."""
+        rows = ['{0:<16}{1:>10}{2:>12}{3:>14}{4:>10}'.format(
+            'construct', 'calls', 'lines', 'chars', 'seconds')]
+        for kind in sorted(self.seconds, key=self.seconds.get, reverse=True):
+            rows.append('{0:<16}{1:>10}{2:>12}{3:>14}{4:>10.3f}'.format(
+                kind, self.calls[kind], self.lines[kind], self.chars[kind],
+                self.seconds[kind]))
+        return '\n'.join(rows)
+
+
+# kind of construct emitted by each instrumented CodeWriter method
+_INSTRUMENTED = {
+    'add_enum': 'enum',
+    'add_struct': 'struct',
+    'add_variable_declaration': 'declaration',
+    'add_variable_declarations': 'declaration',
+    'add_variable_initialization': 'initialization',
+    'add_variable_initializations': 'initialization',
+    'add_variable_initialization_async': 'initialization',
+    'add_variable_initializations_async': 'initialization',
+    'add_function_prototype': 'function',
+    'add_function_definition': 'function',
+    'call_function': 'function',
+    'add_dispatch': 'function',
+    'start_comment': 'comment',
+    'end_comment': 'comment',
+    'add_autogen_comment': 'comment',
+    'add_license_comment': 'comment',
+    'define': 'preprocessor',
+    'include': 'preprocessor',
+    'start_if_def': 'preprocessor',
+    'end_if_def': 'preprocessor',
+    'cpp_entry': 'preprocessor',
+    'cpp_exit': 'preprocessor',
+    'add': 'text',
+    'add_line': 'text',
+    'add_lines': 'text',
+    'open_brace': 'text',
+    'close_brace': 'text',
+    'start_switch': 'text',
+    'end_switch': 'text',
+    'add_case': 'text',
+    'add_default': 'text',
+    'break_from_case': 'text',
+    'return_from_case': 'text',
+    'flush': 'io',
+    'write_to_file': 'io',
+    'write_to': 'io',
+    'write_to_archive': 'io',
+    'flush_async': 'io',
+    'write_to_file_async': 'io',
+}
+
+
+def _instrument(writer, stats, hook):
+    """wrap the methods of a single writer to measure what they emit
+
+    Only the outermost instrumented call is recorded, so the code added by
+    e.g. add_struct is not counted again for the add_line calls it makes.
+    """
+    totals = [0, 0]  # characters and lines added so far
+    depth = [0]
+    line_feed = writer.line_feed
+    add = writer.add
+
+    def counting_add(text):
+        totals[0] += len(text)
+        totals[1] += text.count(line_feed)
+        add(text)
+
+    writer.add = counting_add
+
+    def record(what, name, start, chars, lines):
+        seconds = time.perf_counter() - start
+        chars, lines = totals[0] - chars, totals[1] - lines
+        if stats is not None:
+            stats.record(what, seconds, chars, lines)
+        if hook is not None:
+            hook(what, name, seconds, chars, lines)
+
+    def wrap(name, kind):
+        method = getattr(writer, name)
+
+        def measured(*args, **kwargs):
+            if depth[0]:
+                return method(*args, **kwargs)
+            what = 'comment' if writer.commenting else kind
+            chars, lines = totals
+            depth[0] += 1
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                depth[0] -= 1
+                record(what, name, start, chars, lines)
+
+        async def measured_async(*args, **kwargs):
+            if depth[0]:
+                return await method(*args, **kwargs)
+            what = 'comment' if writer.commenting else kind
+            chars, lines = totals
+            depth[0] += 1
+            start = time.perf_counter()
+            try:
+                return await method(*args, **kwargs)
+            finally:
+                depth[0] -= 1
+                record(what, name, start, chars, lines)
+
+        if inspect.iscoroutinefunction(method):
+            measured = measured_async
+
+        measured.__name__ = name
+        measured.__doc__ = method.__doc__
+        setattr(writer, name, measured)
+
+    for name, kind in _INSTRUMENTED.items():
+        wrap(name, kind)
+
+
 # Main, file-generating class
 
 class CodeWriter:
@@ -279,9 +1452,17 @@ class CodeWriter:
 
     VERSION = "1.1"
 
-    def __init__(self, lf="\n", indent=4):
+    def __init__(self,
+                 lf="\n",
+                 indent=4,
+                 sink=None,
+                 buffer_size=65536,
+                 encoding='utf-8',
+                 stats=None,
+                 hook=None):
 
         self.line_feed = lf
+        self._tabs = 0
         if isinstance(indent, int):
             self.indent = ' ' * indent
         else:
@@ -291,17 +1472,71 @@ class CodeWriter:
         self.commenting = False  # switch for bulk commenting
         self.defs = []  # define levels
         self.switch = []  # switch levels
-        self.tabs = 0
-        self.text = ''  # code
+        self._chunks = []  # code, joined lazily when text is read
+
+        # streaming: code is handed to the sink every buffer_size characters
+        self.sink = sink
+        self.buffer_size = buffer_size
+        self.encoding = encoding  # of files written and binary sinks
+        self._binary = sink is not None and _is_binary_sink(sink)
+        self._pending = 0  # characters buffered since the last flush
+        self._last_async = None  # done once the last async add has added
+        self._written = None  # set once the last write from a thread is done
+
+        # instrumentation: a WriterStats to fill in and/or a callback taking
+        # (kind, method, seconds, chars, lines) for every construct added
+        self.stats = stats
+        self.hook = hook
+        if stats is not None or hook is not None:
+            _instrument(self, stats, hook)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+    @property
+    def text(self):
+        """generated code (read-only)"""
+        if self.sink is not None:
+            raise ValueError('text is not available when streaming to a sink')
+        if len(self._chunks) > 1:
+            # collapse the chunks so that repeated reads stay cheap
+            self._chunks[:] = [''.join(self._chunks)]
+        return self._chunks[0] if self._chunks else ''
+
+    # the indentation of the current tab level is kept in _prefix, so that
+    # it is only rebuilt when the tab level or indent changes
+
+    @property
+    def indent(self):
+        """indentation of a single tab level"""
+        return self._indent
+
+    @indent.setter
+    def indent(self, indent):
+        self._indent = indent
+        self._prefix = indent * self._tabs
+
+    @property
+    def tabs(self):
+        """current tab level"""
+        return self._tabs
+
+    @tabs.setter
+    def tabs(self, tabs):
+        self._tabs = tabs
+        self._prefix = self._indent * tabs
 
     def tab_in(self):
         """increase tab level"""
-        self.tabs += 1
+        self.tabs = self._tabs + 1
 
     def tab_out(self):
         """decrease tab level"""
-        if self.tabs > 0:
-            self.tabs -= 1
+        if self._tabs > 0:
+            self.tabs = self._tabs - 1
 
     def reset_tabs(self):
         self.tabs = 0
@@ -369,7 +1604,7 @@ class CodeWriter:
     def close_brace(self, new_line=True):
         """close-brace and tab-out"""
         self.tab_out()
-        self.add(self.indent * self.tabs + '}')
+        self.add(self._prefix + '}')
         if new_line:
             self.add_line('')
 
@@ -447,32 +1682,89 @@ class CodeWriter:
 
     def add(self, text):
         """add raw text"""
-        self.text += text
+        self._chunks.append(text)
+        if self.sink is not None:
+            self._pending += len(text)
+            if self._pending >= self.buffer_size:
+                self.flush()
+
+    def flush(self):
+        """hand buffered code to the sink (if streaming)"""
+        if self.sink is None or not self._chunks:
+            return
+        data = self.__take()
+        if self._written is not None:
+            self._written.wait()  # writes from flush_async go first
+        self.__write(data)
+
+    async def flush_async(self):
+        """flush from a thread, without blocking the event loop
+
+        The buffered code is taken right away, only the write to the sink
+        happens in the thread. Writes reach the sink in the order of the
+        flushes.
+        """
+        if self.sink is None or not self._chunks:
+            return
+        data = self.__take()
+        previous, written = self._written, threading.Event()
+        self._written = written
+
+        def write():
+            try:
+                if previous is not None:
+                    previous.wait()
+                self.__write(data)
+            finally:
+                written.set()
+        await asyncio.get_running_loop().run_in_executor(None, write)
+
+    def __take(self):
+        """take the buffered code"""
+        data = ''.join(self._chunks)
+        self._chunks = []
+        self._pending = 0
+        return data
+
+    def __write(self, data):
+        if self._binary:
+            data = data.encode(self.encoding)
+        self.sink.write(data)
 
     def add_line(self, text=None, comment=None, ignore_tabs=False):
         """add a line of (formatted) text"""
 
-        # empty line
-        if not text and not comment and not self.commenting:
+        if self.commenting:
+            start = "* "
+        elif not text and not comment:
+            # empty line
             self.add(self.line_feed)
             return
+        elif ignore_tabs:
+            start = ''
+        else:
+            start = self._prefix
 
-        if not ignore_tabs and not self.commenting:
-            self.add(self.indent * self.tabs)
-
-        if self.commenting:
-            self.add("* ")
-
-        # add the text (if appropriate)
-        if text:
-            self.add(text)
-        # add a trailing comment (if appropriate)
-        if comment:
-            if text:
-                self.add(' ')  # add a space after the text
-            self.add('//' + comment)
-
-        self.add(self.line_feed)
+        # the whole line is added in one go
+        if not comment:
+            self.add(start + (text or '') + self.line_feed)
+        elif text:
+            self.add(start + text + ' //' + comment + self.line_feed)
+        else:
+            self.add(start + '//' + comment + self.line_feed)
+
+    def add_lines(self, lines):
+        """add lines of already formatted text at the current tab level"""
+        lf = self.line_feed
+        start = "* " if self.commenting else self._prefix
+        lines = iter(lines)
+        while True:
+            # join the lines in batches to keep the number of chunks low
+            batch = [start + line + lf if line or self.commenting else lf
+                     for line in islice(lines, 1024)]
+            if not batch:
+                break
+            self.add(''.join(batch))
 
     def include(self, file, comment=None):
         """add a c-style include"""
@@ -486,6 +1778,9 @@ class CodeWriter:
         if not isinstance(enum, Enum):
             raise TypeError('enum must be of type "Enum"')
 
+        self.__add_rendered(enum, CodeWriter.__add_enum)
+
+    def __add_enum(self, enum):
         self.add_line("typedef enum")
         self.open_brace()
 
@@ -503,31 +1798,130 @@ class CodeWriter:
         self.add(' ' + enum.name + ';')
         self.add_line()
 
+    def __add_rendered(self, construct, add):
+        """add the code of an Enum or Struct, rendered once per layout
+
+        The code is cached on the construct (keyed by indentation and line
+        feed) so that emitting the same definition into many files is a
+        single string copy. The cached code is only used while the stamps of
+        the construct and its members are unchanged, as members may be
+        edited in place.
+        """
+        if self.commenting:
+            add(self, construct)
+            return
+        key = (self._indent, self.line_feed, self._tabs)
+        signature = construct._signature()
+        cached = construct._rendered.get(key)
+        if cached is not None and cached[0] == signature:
+            text = cached[1]
+        else:
+            scratch = CodeWriter(lf=self.line_feed, indent=self._indent)
+            scratch.tabs = self._tabs
+            add(scratch, construct)
+            text = scratch.text
+            construct._rendered[key] = (signature, text)
+        self.add(text)
+
     def add_variable_declaration(self, var, extern=False):
         """add a variable declaration"""
-        if not isinstance(var, Variable):
-            raise TypeError("variable must be of type 'Variable'")
-
-        self.add_line(var.declaration(extern) + ";", comment=var.comment)
+        self.add_variable_declarations((var, ), extern)
+
+    def add_variable_declarations(self, variables, extern=False):
+        """add declarations of an iterable of variables"""
+        prefix = self._prefix
+        for var in variables:
+            if not isinstance(var, Variable):
+                raise TypeError("variable must be of type 'Variable'")
+
+            if self.commenting:
+                self.add_line(
+                    var.declaration(extern) + ";", comment=var.comment)
+                continue
+            line = prefix + var.declaration(extern) + ";"
+            if var.comment:
+                line += ' //' + var.comment
+            self.add(line + self.line_feed)
 
     def add_variable_initialization(self, var):
         """add a variable initialization"""
-        if not isinstance(var, Variable):
-            raise TypeError("variable must be of type 'Variable'")
+        self.add_variable_initializations((var, ))
+
+    def add_variable_initializations(self, variables):
+        """add initializations of an iterable of variables
+
+        The initializers are written straight into the code, with all lines
+        after the first indented one level deeper.
+        """
+        prefix = self._prefix
+        newline = self.line_feed + prefix + self.indent
+        for var in variables:
+            if not isinstance(var, Variable):
+                raise TypeError("variable must be of type 'Variable'")
+
+            if self.commenting:
+                initlines = var.initialization(self.indent).splitlines()
+                self.add_line(initlines[0], comment=var.comment)
+                for line in initlines[1:]:
+                    self.add_line(line)
+                continue
+            self.add(prefix)
+            if var.comment:
+                append = _CommentedLine(self.add, var.comment, self.line_feed)
+                var.emit_initialization(append, self.indent, newline)
+                append.finish()
+            else:
+                var.emit_initialization(self.add, self.indent, newline)
+            self.add(self.line_feed)
 
-        initlines = var.initialization(self.indent).splitlines()
-        self.add_line(initlines[0], comment=var.comment)
-        if len(initlines) > 1:
-            self.tab_in()
-            for line in initlines[1:]:
-                self.add_line(line)
-            self.tab_out()
+    async def add_variable_initialization_async(self, var, executor=None):
+        """add a variable initialization without blocking the event loop"""
+        await self.add_variable_initializations_async((var, ), executor)
+
+    async def add_variable_initializations_async(self, variables,
+                                                 executor=None):
+        """add initializations without blocking the event loop
+
+        The code is generated in executor (the loop's default thread pool if
+        None). With a process pool, large tables are generated without
+        holding up other threads, but the variables must then be picklable,
+        which excludes lazy iterator values. Concurrent calls are generated
+        in parallel, but their code is added in the order of the calls.
+        """
+        loop = asyncio.get_running_loop()
+        rendering = loop.run_in_executor(
+            executor, _render_initializations, list(variables),
+            self._indent, self.line_feed, self._tabs, self.commenting)
+        # reserve the place of the code before awaiting anything
+        previous, done = self._last_async, loop.create_future()
+        self._last_async = done
+        try:
+            text = await rendering
+            if previous is not None and not previous.done():
+                await previous
+            if self.sink is None:
+                self.add(text)
+                return
+            # added without flushing, the sink is written to from a thread
+            sink, self.sink = self.sink, None
+            try:
+                self.add(text)
+            finally:
+                self.sink = sink
+            self._pending += len(text)
+            if self._pending >= self.buffer_size:
+                await self.flush_async()
+        finally:
+            done.set_result(None)
 
     def add_struct(self, struct):
         """add a struct"""
         if not isinstance(struct, Struct):
             raise TypeError("struct must be of type 'Struct'")
 
+        self.__add_rendered(struct, CodeWriter.__add_struct)
+
+    def __add_struct(self, struct):
         self.add_line("typedef struct")
         self.open_brace()
 
@@ -565,7 +1959,1017 @@ class CodeWriter:
 
         self.add_line(func.call(*arg))
 
-    def write_to_file(self, file):
-        """write code to file"""
-        with open(file, 'w') as the_file:
-            the_file.write(self.text)
+    def add_dispatch(self, dispatch):
+        """add the lookup function of a Dispatch, and its tables"""
+        if not isinstance(dispatch, Dispatch):
+            raise TypeError("dispatch must be of type 'Dispatch'")
+
+        strategy = dispatch.choose_strategy()
+        cases = dispatch.cases
+        keys = sorted(cases)
+        if strategy == 'switch' or not keys:
+            self.add_function_definition(dispatch.function())
+            self.open_brace()
+            self.add_line('switch (key)')
+            self.open_brace()
+            for key in keys:
+                self.add_case(key)
+                self.add_line('return {0};'.format(cases[key]))
+                self.tab_out()
+            self.add_default()
+            self.add_line('return {0};'.format(dispatch.default))
+            self.tab_out()
+            self.close_brace()
+            self.close_brace()
+            return
+
+        if strategy == 'table':
+            low = keys[0]
+            size = keys[-1] - low + 1
+            table = dispatch.name + '_table'
+            self._add_table(
+                'static const {0} {1}[{2}]'.format(
+                    dispatch.value_type, table, size),
+                [cases.get(key, dispatch.default)
+                 for key in range(low, low + size)])
+            self.add_line()
+            self.add_function_definition(dispatch.function())
+            self.open_brace()
+            index = '(unsigned long long)key'
+            if low:
+                index += ' - (unsigned long long)({0})'.format(low)
+            self.add_line('unsigned long long index = {0};'.format(index))
+            self.add_line('if (index < {0})'.format(size))
+            self.tab_in()
+            self.add_line('return {0}[index];'.format(table))
+            self.tab_out()
+        else:
+            size = len(keys)
+            table = dispatch.name + '_keys'
+            self._add_table(
+                'static const {0} {1}[{2}]'.format(
+                    dispatch.key_type, table, size), keys)
+            self._add_table(
+                'static const {0} {1}_values[{2}]'.format(
+                    dispatch.value_type, dispatch.name, size),
+                [cases[key] for key in keys])
+            self.add_line()
+            self.add_function_definition(dispatch.function())
+            self.open_brace()
+            # branchless lower bound, compiled to conditional moves
+            self.add_line('unsigned int low = 0;')
+            self.add_line('unsigned int count = {0};'.format(size))
+            self.add_line('while (count > 1)')
+            self.open_brace()
+            self.add_line('unsigned int half = count / 2;')
+            self.add_line(
+                'low = {0}[low + half] <= key ? low + half : low;'.format(table))
+            self.add_line('count -= half;')
+            self.close_brace()
+            self.add_line('if ({0}[low] == key)'.format(table))
+            self.tab_in()
+            self.add_line('return {0}_values[low];'.format(dispatch.name))
+            self.tab_out()
+        self.add_line('return {0};'.format(dispatch.default))
+        self.close_brace()
+
+    def _add_table(self, declaration, entries, row_length=8):
+        """add a static array of C expressions, row_length per line"""
+        entries = [str(entry) for entry in entries]
+        self.add_line(declaration + ' =')
+        self.open_brace()
+        for i in range(0, len(entries), row_length):
+            row = ', '.join(entries[i:i + row_length])
+            self.add_line(row + ',' if i + row_length < len(entries) else row)
+        self.close_brace(new_line=False)
+        self.add(';')
+        self.add_line()
+
+    def write_to_file(self, file, atomic=False, if_changed=False,
+                      manifest=None, compression=None):
+        """write code to file (atomically: via a temporary file)
+
+        With if_changed, the file is left untouched (keeping its mtime) when
+        it already holds this code, judged by the digest recorded in manifest
+        or else by reading the file. Returns whether the file was written.
+        The file is written in the writer's encoding. compression can be
+        'gzip', 'xz' or 'zstd' (needs zstandard); the code is then compressed
+        as it is written.
+        """
+        if self.sink is not None:
+            raise ValueError('cannot write_to_file when streaming to a sink')
+        opener = _text_opener(compression, self.encoding)
+        digest = None
+        if if_changed or manifest is not None:
+            digest = _text_digest(self._chunks)
+        if if_changed and os.path.exists(file):
+            previous = manifest.content(file) if manifest is not None else None
+            if digest == (previous or _file_digest(file, opener)):
+                if manifest is not None:
+                    manifest.record(file, content=digest)
+                return False
+
+        if atomic:
+            _write_atomically(file, self._chunks, opener)
+        else:
+            with opener(file, 'wt') as the_file:
+                the_file.writelines(self._chunks)
+        if manifest is not None:
+            manifest.record(file, content=digest)
+        return True
+
+    async def write_to_file_async(self, file, atomic=False, if_changed=False,
+                                  manifest=None, compression=None):
+        """write_to_file from a thread, without blocking the event loop
+
+        The code must not be added to while it is written.
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            None,
+            partial(self.write_to_file, file, atomic, if_changed, manifest,
+                    compression))
+
+    def write_to(self, stream):
+        """write code to an open file object
+
+        Binary streams (e.g. io.BytesIO, gzip.GzipFile) get the code encoded
+        in the writer's encoding. Line feeds are written as they are.
+        """
+        if self.sink is not None:
+            raise ValueError('cannot write_to when streaming to a sink')
+        if _is_binary_sink(stream):
+            stream.writelines(
+                chunk.encode(self.encoding) for chunk in self._chunks)
+        else:
+            stream.writelines(self._chunks)
+
+    def write_to_archive(self, archive, name):
+        """add code as member name of an open tarfile or zipfile archive"""
+        if self.sink is not None:
+            raise ValueError(
+                'cannot write_to_archive when streaming to a sink')
+        if isinstance(archive, zipfile.ZipFile):
+            with archive.open(name, 'w') as member:
+                self.write_to(member)
+        elif isinstance(archive, tarfile.TarFile):
+            # tar needs the size of a member before its data
+            data = ''.join(self._chunks).encode(self.encoding)
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = time.time()
+            info.mode = _file_mode()
+            archive.addfile(info, io.BytesIO(data))
+        else:
+            raise TypeError('archive must be a tarfile.TarFile or '
+                            'zipfile.ZipFile, not {0}'.format(
+                                type(archive).__name__))
+
+
+# pooling of initializer data
+
+# escapes of one byte each in a C string literal; \x takes all hex digits
+_C_ESCAPES = re.compile(r'\\(?:x[0-9A-Fa-f]+|[0-7]{1,3}|[abfnrtv\\\'"?])')
+
+
+def _c_string_size(text):
+    """size of the char array initialized by the C string literal text,
+    None if it has escapes whose size depends on the compiler (\\u...)"""
+    plain, escapes = _C_ESCAPES.subn('', text)
+    if '\\' in plain:
+        return None
+    return len(plain.encode('utf-8')) + escapes + 1
+
+
+class InitializerPool:
+    """emits equal constant initializers only once, across CodeWriters
+
+    Variables declared and initialized through the pool are compared by
+    type, qualifiers, dimensions and value. The first of equal const arrays
+    is initialized as usual, later ones become aliases of it: const pointers
+    (alias='pointer') or #defines (alias='define'). A pointer alias costs
+    the size of a pointer, so it only pays off for arrays larger than that.
+
+    With strings set, const char strings are deduplicated as well. Using
+    #defines, every string is stored once in a char array of that name (see
+    add_strings) and its variables are defines pointing into it, at no cost
+    of their own. Using pointers, strings longer than a pointer are aliased
+    like arrays instead, so that strings never cost more than without the
+    pool. Other variables, such as non-const, static or lazy ones, are
+    passed through unchanged, as are strings with \\u escapes.
+    """
+
+    ALIASES = ('pointer', 'define')
+
+    def __init__(self, alias='pointer', strings=None):
+        if alias not in self.ALIASES:
+            raise ValueError('alias must be one of {0}'.format(
+                ', '.join(self.ALIASES)))
+        self.alias = alias
+        self.strings = strings  # name of the pooled char array
+        self.saved = 0  # bytes saved, less the size of pointer aliases
+        self.duplicates = 0  # variables turned into aliases
+        self._entries = {}  # (kind, target) by variable name
+        self._firsts = {}  # first variable by digest of its data
+        self._offsets = {}  # offset in the pool by string
+        self._pooled = []  # strings in the pool, in order
+        self._size = 0  # bytes in the pool
+        self._seen = weakref.WeakKeyDictionary()  # names known to writers
+
+    def __register(self, var):
+        """decide how var is emitted: (None, None) for unchanged, ('alias',
+        first variable) or ('string', offset in the pool)"""
+        entry = self._entries.get(var.name)
+        if entry is not None:
+            return entry
+        entry = (None, None)
+        pointer = Struct.LAYOUT['void *'][0] if self.alias == 'pointer' else 0
+        qualifiers = _qualifiers(var).split()
+        if ('const' in qualifiers and 'static' not in qualifiers
+                and not isinstance(var, Blob)):
+            size = None
+            if (self.strings is not None and isinstance(var.value, str)
+                    and ' '.join(var.primitive.split()) == 'char'):
+                size = _c_string_size(var.value)
+            if size is not None and self.alias == 'define':
+                offset = self._offsets.get(var.value)
+                if offset is None:
+                    offset = self._offsets[var.value] = self._size
+                    self._pooled.append(var.value)
+                    self._size += size
+                else:
+                    self.saved += size
+                    self.duplicates += 1
+                entry = ('string', offset)
+            elif size is not None and size > pointer:
+                digest = fingerprint(var.primitive, _qualifiers(var),
+                                     var.array, var.value)
+                first = self._firsts.setdefault(digest, var)
+                if first is not var:
+                    self.saved += size - pointer
+                    self.duplicates += 1
+                    entry = ('alias', first)
+            elif isinstance(var.value, _SEQUENCES):
+                digest = fingerprint(var.primitive, _qualifiers(var),
+                                     var.array, var.value)
+                first = self._firsts.setdefault(digest, var)
+                if first is not var:
+                    size = Struct.LAYOUT.get(
+                        ' '.join(var.primitive.split()), (0, 0))[0]
+                    for dim in _dimensions(var):
+                        size *= int(dim)
+                    self.saved += size - pointer
+                    self.duplicates += 1
+                    entry = ('alias', first)
+        self._entries[var.name] = entry
+        return entry
+
+    def __seen(self, writer):
+        return self._seen.setdefault(writer, set())
+
+    def __declare_strings(self, writer):
+        """declare the pool in writer, once"""
+        seen = self.__seen(writer)
+        if self.strings not in seen:
+            writer.add_line('extern const char {0}[];'.format(self.strings))
+            seen.add(self.strings)
+
+    def __alias(self, var, kind, target, extern=False):
+        """line of code aliasing var to its target"""
+        if kind == 'string':
+            target = '({0} + {1})'.format(self.strings, target)
+        else:
+            target = target.name
+        if self.alias == 'define':
+            return '#define {0} {1}'.format(var.name, target)
+
+        if kind == 'string':
+            pointer = '*const ' + var.name
+        else:
+            dims = _dimensions(var)
+            pointer = '(*const {0}){1}'.format(
+                var.name, ''.join('[{0}]'.format(dim) for dim in dims[1:]))
+            if len(dims) < 2:
+                pointer = '*const ' + var.name
+        declaration = '{ext}{qual}{prim} {pointer}'.format(
+            ext='extern ' if extern else '',
+            qual=_qualifiers(var),
+            prim=var.primitive,
+            pointer=pointer)
+        if extern:
+            return declaration + ';'
+        return '{0} = {1};'.format(declaration, target)
+
+    def add_variable_declaration(self, writer, var, extern=False):
+        """declare var in writer, as an alias if its data is pooled"""
+        kind, target = self.__register(var)
+        if kind is None:
+            writer.add_variable_declaration(var, extern)
+            return
+        if kind == 'string':
+            self.__declare_strings(writer)
+        writer.add_line(self.__alias(var, kind, target, extern),
+                        comment=var.comment)
+
+    def add_variable_initialization(self, writer, var):
+        """initialize var in writer, or alias it to pooled data"""
+        kind, target = self.__register(var)
+        seen = self.__seen(writer)
+        if kind is None:
+            writer.add_variable_initialization(var)
+            seen.add(var.name)
+            return
+        if kind == 'string':
+            self.__declare_strings(writer)
+        elif target.name not in seen:
+            # initialized in another file, or further down
+            writer.add_variable_declaration(target, extern=True)
+            seen.add(target.name)
+        writer.add_line(self.__alias(var, kind, target), comment=var.comment)
+
+    def add_strings(self, writer):
+        """define the char array of the pooled strings (alias='define')"""
+        writer.add_line('const char {0}[] ='.format(self.strings))
+        writer.tab_in()
+        if not self._pooled:
+            writer.add_line('"";')
+        for i, text in enumerate(self._pooled):
+            if i + 1 < len(self._pooled):
+                writer.add_line('"{0}\\0"'.format(text))
+            else:
+                writer.add_line('"{0}";'.format(text))
+        writer.tab_out()
+
+    def report(self):
+        """Return a summary of the pooled data."""
+        return ('{dup} duplicate initializers aliased, {count} strings '
+                'pooled in {size} bytes, {saved} bytes saved'.format(
+                    dup=self.duplicates,
+                    count=len(self._pooled),
+                    size=self._size,
+                    saved=self.saved))
+
+
+# sharding of large initializers
+
+class ShardedVariable:
+    """an array Variable split into shards of rows, one per source file
+
+    Each shard is a Variable named <name>_<index> holding up to rows
+    elements of the first dimension, so that the shards can be compiled in
+    parallel. The index table, named like the variable, points to the
+    shards, and <NAME>_AT(i) reads row i through it. Lazy (iterator) values
+    are consumed shard by shard, and shards are streamed to their files.
+    """
+
+    def __init__(self, var, rows, index=True):
+        if not isinstance(var, Variable):
+            raise TypeError("variable must be of type 'Variable'")
+        if rows < 1:
+            raise ValueError('rows must be at least 1')
+        if not isinstance(var.value, _SEQUENCES + (Iterator, )):
+            raise ValueError(
+                'no array value to shard for Variable "{name}"'.format(
+                    name=var.name))
+        self.var = var
+        self.rows = rows  # rows (elements of the first dimension) per shard
+        self.index = index  # whether to emit the index table
+        self.dims = var.value_shape()
+
+    def __len__(self):
+        return -(-self.dims[0] // self.rows)
+
+    def __shard_rows(self, i):
+        return min(self.rows, self.dims[0] - i * self.rows)
+
+    def __shard_name(self, i):
+        return '{0}_{1}'.format(self.var.name, i)
+
+    def __macro(self, suffix):
+        return '{0}_{1}'.format(self.var.name.upper(), suffix)
+
+    def shards(self):
+        """Yield the shards as Variables, taking the value as it goes."""
+        var = self.var
+        lazy = isinstance(var.value, Iterator)
+        size = 1
+        for dim in self.dims[1:]:
+            size *= dim
+        for i in range(len(self)):
+            count = self.__shard_rows(i)
+            start = i * self.rows
+            if lazy:
+                value = islice(var.value, count * size)
+            else:
+                value = var.value[start:start + count]
+            yield Variable(
+                self.__shard_name(i),
+                var.primitive,
+                qualifiers=var.qualifiers,
+                array=[count] + self.dims[1:] if lazy else None,
+                value=value,
+                value_opts=var.value_opts,
+                compress=var.compress)
+        if lazy and next(var.value, _END) is not _END:
+            raise ValueError(
+                'lazy value of Variable "{name}" has more elements than '
+                'its array dimensions'.format(name=var.name))
+
+    def __index_declaration(self, extern=False):
+        rows = ''.join('[{0}]'.format(dim) for dim in self.dims[1:])
+        if rows:
+            target = '(*const {0}[{1}]){2}'.format(self.var.name, len(self),
+                                                   rows)
+        else:
+            target = '*const {0}[{1}]'.format(self.var.name, len(self))
+        return '{ext}{qual}{prim} {target}'.format(
+            ext='extern ' if extern else '',
+            qual=_qualifiers(self.var),
+            prim=self.var.primitive,
+            target=target)
+
+    def add_declarations(self, writer):
+        """declare the shards and the index table (for a header)"""
+        writer.define(self.__macro('SHARD_ROWS'), self.rows)
+        writer.define(self.__macro('SHARDS'), len(self))
+        declarations = [
+            Variable(self.__shard_name(i), self.var.primitive,
+                     qualifiers=self.var.qualifiers,
+                     array=[self.__shard_rows(i)] + self.dims[1:])
+            for i in range(len(self))]
+        writer.add_variable_declarations(declarations, extern=True)
+        if self.index:
+            writer.add_line(self.__index_declaration(extern=True) + ';',
+                            comment=self.var.comment)
+            writer.define(
+                self.__macro('AT(i)'),
+                '({name}[(i) / {rows}][(i) % {rows}])'.format(
+                    name=self.var.name, rows=self.__macro('SHARD_ROWS')))
+
+    def add_index(self, writer):
+        """define the index table pointing to the shards"""
+        writer._add_table(self.__index_declaration(),
+                          [self.__shard_name(i) for i in range(len(self))])
+
+    def __write_shard(self, writer, i, shard, includes):
+        for file in includes:
+            writer.include(file)
+        if includes:
+            writer.add_line()
+        writer.add_variable_initialization(shard)
+        if i == 0 and self.index:
+            writer.add_line()
+            self.add_index(writer)
+
+    def write_shards(self, directory='.', pattern='{name}_{index}.c',
+                     includes=(), lf="\n", indent=4, buffer_size=65536,
+                     encoding='utf-8', if_changed=False, manifest=None):
+        """write each shard to its own file, streaming
+
+        Files are named by pattern, formatted with the variable name and the
+        shard index; includes are added to the top of each and should bring
+        in the declarations of add_declarations, as the index table goes
+        into the file of the first shard. With if_changed, each shard is
+        generated in memory and its file is only rewritten when the code
+        changed (see CodeWriter.write_to_file), so that build tools only
+        recompile the shards that changed. Returns the paths of the files.
+        """
+        paths = []
+        for i, shard in enumerate(self.shards()):
+            path = os.path.join(directory, pattern.format(
+                name=self.var.name, index=i))
+            if if_changed:
+                writer = CodeWriter(lf=lf, indent=indent, encoding=encoding)
+                self.__write_shard(writer, i, shard, includes)
+                writer.write_to_file(path, atomic=True, if_changed=True,
+                                     manifest=manifest)
+            else:
+                with open(path, 'w', encoding=encoding) as the_file, \
+                        CodeWriter(lf=lf, indent=indent, sink=the_file,
+                                   buffer_size=buffer_size,
+                                   encoding=encoding) as writer:
+                    self.__write_shard(writer, i, shard, includes)
+            paths.append(path)
+        return paths
+
+
+# incremental generation
+
+def _code_digest(code):
+    """digest of a code object, including the functions defined in it"""
+    digest = hashlib.sha256(code.co_code)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            digest.update(_code_digest(const).encode())
+        else:
+            digest.update(repr(const).encode())
+    digest.update(repr(code.co_names).encode())
+    return digest.hexdigest()
+
+
+@lru_cache(maxsize=64)
+def _source_file_digest(path, mtime, size):
+    with open(path, 'rb') as the_file:
+        return hashlib.sha256(the_file.read()).hexdigest()
+
+
+def _source_digest(func):
+    """digest of the source file of the module defining func
+
+    Helpers and tables the function uses from its module are covered this
+    way. Without a source file, the digest is different every time, so that
+    the function counts as changed rather than risking stale output.
+    """
+    try:
+        path = inspect.getsourcefile(func)
+        stat = os.stat(path)
+        return _source_file_digest(path, stat.st_mtime_ns, stat.st_size)
+    except (TypeError, OSError):
+        return os.urandom(16).hex()
+
+
+class _FingerprintPickler(pickle.Pickler):
+    """pickles functions by their name, code and module source rather than by
+    name only, so that fingerprints change with the code of build functions"""
+
+    def reducer_override(self, obj):
+        if isinstance(obj, types.FunctionType):
+            return str, ('{0}.{1} {2} {3} {4!r}'.format(
+                obj.__module__, obj.__qualname__,
+                _code_digest(obj.__code__), _source_digest(obj),
+                obj.__defaults__), )
+        return NotImplemented
+
+
+def fingerprint(*objects):
+    """Return a digest identifying objects (Variables, Structs, plain data...)
+
+    Objects are compared by their pickled state, so anything that can be
+    handed to a worker process can be fingerprinted. Functions are compared
+    by their code and the source of their module as well.
+    """
+    data = io.BytesIO()
+    _FingerprintPickler(data, protocol=4).dump((CodeWriter.VERSION, objects))
+    return hashlib.sha256(data.getvalue()).hexdigest()
+
+
+class Manifest:
+    """sidecar record of generated files, used to skip unchanged work
+
+    For each output file it keeps the digest of the written code and the
+    fingerprint of the inputs it was generated from. The record is stored
+    as JSON at path, or only kept in memory when path is None.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as the_file:
+                self.entries = json.load(the_file)
+
+    def _key(self, file):
+        file = os.path.abspath(file)
+        if self.path is None:
+            return file
+        return os.path.relpath(file,
+                               os.path.dirname(os.path.abspath(self.path)))
+
+    def content(self, file):
+        """digest of the code last written to file"""
+        return self.entries.get(self._key(file), {}).get('content')
+
+    def inputs(self, file):
+        """fingerprint of the inputs file was last generated from"""
+        return self.entries.get(self._key(file), {}).get('inputs')
+
+    def record(self, file, content=None, inputs=None):
+        """note the code digest and/or inputs fingerprint of file"""
+        entry = self.entries.setdefault(self._key(file), {})
+        if content is not None:
+            if inputs is None and entry.get('content') != content:
+                entry.pop('inputs', None)  # no longer known
+            entry['content'] = content
+        if inputs is not None:
+            entry['inputs'] = inputs
+
+    def save(self):
+        """store the manifest at its path"""
+        if self.path is None:
+            raise ValueError('no path supplied for Manifest')
+        _write_atomically(
+            self.path, [json.dumps(self.entries, indent=1, sort_keys=True)])
+
+
+# batch generation of many files
+
+class FileJob:
+    """a file to be generated by generate_files
+
+    build is called with a fresh CodeWriter followed by args, and fills the
+    writer in. As jobs run in worker processes, build must be a module-level
+    function and args must be picklable. inputs lists any further objects
+    the output depends on, for skipping jobs whose inputs did not change.
+    """
+
+    def __init__(self, path, build, args=(), lf="\n", indent=4, inputs=()):
+        self.path = path
+        self.build = build
+        self.args = args
+        self.lf = lf
+        self.indent = indent
+        self.inputs = inputs
+
+    def fingerprint(self):
+        """fingerprint of everything the generated file depends on"""
+        return fingerprint(self.build, self.args, self.inputs, self.lf,
+                           self.indent)
+
+
+class JobResult:
+    """outcome of a FileJob
+
+    status is 'written', 'unchanged' (generated, but the file already held
+    the same code) or 'skipped' (inputs unchanged, nothing generated).
+    """
+
+    def __init__(self, path, seconds, status='written', digest=None):
+        self.path = path
+        self.seconds = seconds  # time spent generating and writing
+        self.status = status
+        self.digest = digest  # of the generated code
+
+    def __repr__(self):
+        return '{cls}({path!r}, {sec:.3f}, {status!r})'.format(
+            cls=type(self).__name__,
+            path=self.path,
+            sec=self.seconds,
+            status=self.status)
+
+
+def _run_job(job, digest=None):
+    """generate a single file, writing it (atomically) only if it changed"""
+    start = time.perf_counter()
+    manifest = Manifest()
+    if digest is not None:
+        manifest.record(job.path, content=digest)
+    writer = CodeWriter(lf=job.lf, indent=job.indent)
+    job.build(writer, *job.args)
+    written = writer.write_to_file(
+        job.path, atomic=True, if_changed=True, manifest=manifest)
+    return JobResult(job.path,
+                     time.perf_counter() - start,
+                     'written' if written else 'unchanged',
+                     manifest.content(job.path))
+
+
+def generate_files(jobs, processes=None, manifest=None):
+    """generate files in parallel, one worker process per core by default
+
+    Files are only rewritten when their code changed. With a manifest, jobs
+    whose inputs have not changed since the last run are skipped entirely,
+    and the manifest is updated and saved afterwards.
+    Returns a JobResult per job, in the order of jobs.
+    """
+    results = _generate(list(jobs), manifest, processes)
+    if manifest is not None and manifest.path is not None:
+        manifest.save()
+    return results
+
+
+def _generate(jobs, manifest, processes, pool=None):
+    """run the jobs that are not up to date, recording them in manifest"""
+    results = [None] * len(jobs)
+    todo = []
+    inputs = {}
+    for i, job in enumerate(jobs):
+        if manifest is not None:
+            inputs[i] = job.fingerprint()
+            if (manifest.inputs(job.path) == inputs[i]
+                    and os.path.exists(job.path)):
+                results[i] = JobResult(job.path, 0.0, 'skipped',
+                                       manifest.content(job.path))
+                continue
+        todo.append(i)
+
+    pending = [jobs[i] for i in todo]
+    digests = [manifest.content(job.path) if manifest is not None else None
+               for job in pending]
+    if processes == 1 or len(pending) < 2:
+        done = list(map(_run_job, pending, digests))
+    elif pool is not None:
+        done = list(pool.map(_run_job, pending, digests))
+    else:
+        with ProcessPoolExecutor(processes) as pool:
+            done = list(pool.map(_run_job, pending, digests))
+    for i, result in zip(todo, done):
+        results[i] = result
+
+    if manifest is not None:
+        for i, result in zip(todo, done):
+            manifest.record(result.path, content=result.digest,
+                            inputs=inputs[i])
+    return results
+
+
+# projects of headers and sources
+
+def _type_names(primitive):
+    """names a primitive type may refer to, e.g. Channel in 'struct Channel *'"""
+    return [('type', word) for word in primitive.replace('*', ' ').split()]
+
+
+class ProjectFile:
+    """a header or source file of a Project and the constructs it emits
+
+    Constructs are emitted in the order they are added, after the includes.
+    """
+
+    def __init__(self, path, header=False, guard=None, includes=()):
+        self.path = path
+        self.header = header
+        self.guard = guard  # include guard of a header, derived from path
+        self.includes = list(includes)  # written as given, e.g. <stdint.h>
+        self.items = []  # (kind, construct, extra) in order of addition
+
+    def include(self, file):
+        """include another file, e.g. '<stdint.h>' or '"other.h"'"""
+        self.includes.append(file)
+
+    def add_struct(self, struct):
+        """define a struct type"""
+        if not isinstance(struct, Struct):
+            raise TypeError("struct must be of type 'Struct'")
+        self.items.append(('struct', struct, None))
+
+    def add_enum(self, enum):
+        """define an enum type"""
+        if not isinstance(enum, Enum):
+            raise TypeError("enum must be of type 'Enum'")
+        self.items.append(('enum', enum, None))
+
+    def add_variable_declaration(self, var):
+        """declare a variable (extern in headers)"""
+        if not isinstance(var, Variable):
+            raise TypeError("variable must be of type 'Variable'")
+        self.items.append(('declaration', var, None))
+
+    def add_variable_initialization(self, var):
+        """define and initialize a variable"""
+        if not isinstance(var, Variable):
+            raise TypeError("variable must be of type 'Variable'")
+        self.items.append(('initialization', var, None))
+
+    def add_function_prototype(self, func, comment=None):
+        """declare a function"""
+        if not isinstance(func, Function):
+            raise TypeError("func must be of type 'Function'")
+        self.items.append(('prototype', func, comment))
+
+    def add_function_definition(self, func, body=(), comment=None):
+        """define a function, body being its lines of code"""
+        if not isinstance(func, Function):
+            raise TypeError("func must be of type 'Function'")
+        self.items.append(('definition', func, (list(body), comment)))
+
+    def add_dispatch(self, dispatch):
+        """define the lookup function of a Dispatch"""
+        if not isinstance(dispatch, Dispatch):
+            raise TypeError("dispatch must be of type 'Dispatch'")
+        self.items.append(('dispatch', dispatch, None))
+
+    def add_code(self, build, *args):
+        """add code written by build(writer, *args)
+
+        Like FileJob builds, build must be a module-level function and args
+        must be picklable. Files it depends on must be included explicitly.
+        """
+        self.items.append(('code', build, args))
+
+    def use(self, *constructs):
+        """note Variables, Functions, Structs or Enums that code or function
+        bodies of this file refer to, so that their headers are included"""
+        for construct in constructs:
+            if not isinstance(construct, (Variable, Function, Struct, Enum)):
+                raise TypeError("construct must be 'Variable', 'Function', "
+                                "'Struct' or 'Enum'")
+            # only the name, so that changes elsewhere leave this file be
+            if isinstance(construct, Variable):
+                name = ('variable', construct.name)
+            elif isinstance(construct, Function):
+                name = ('function', construct.name)
+            else:
+                name = ('type', construct.name)
+            self.items.append(('use', name, None))
+
+    def provides(self):
+        """set of the types, variables and functions this file defines"""
+        names = set()
+        for kind, construct, _ in self.items:
+            if kind in ('struct', 'enum'):
+                names.add(('type', construct.name))
+            elif kind in ('declaration', 'initialization'):
+                names.add(('variable', construct.name))
+            elif kind in ('prototype', 'definition', 'dispatch'):
+                names.add(('function', construct.name))
+        return names
+
+    def requires(self):
+        """set of the types, variables and functions this file uses"""
+        names = set()
+        for kind, construct, _ in self.items:
+            if kind == 'struct':
+                for var in construct.variables:
+                    if isinstance(var, Struct):
+                        names.add(('type', var.name))
+                    else:
+                        names.update(_type_names(var.primitive))
+            elif kind in ('declaration', 'initialization'):
+                names.update(_type_names(construct.primitive))
+                if kind == 'initialization':
+                    names.add(('variable', construct.name))
+            elif kind in ('prototype', 'definition'):
+                names.update(_type_names(construct.return_type))
+                for var in construct.variables:
+                    names.update(_type_names(var.primitive))
+                if kind == 'definition':
+                    names.add(('function', construct.name))
+            elif kind == 'dispatch':
+                names.update(_type_names(construct.key_type))
+                names.update(_type_names(construct.value_type))
+                names.add(('function', construct.name))
+            elif kind == 'use':
+                names.add(construct)
+        return names
+
+    @staticmethod
+    def default_guard(path):
+        """include guard derived from the whole project-relative path, so that
+        x/config.h and y/config.h get different guards"""
+        guard = re.sub('[^0-9A-Za-z]', '_',
+                       os.path.normpath(path)).strip('_').upper()
+        return guard if guard[:1].isalpha() else 'FILE_' + guard
+
+    def build(self, writer, includes=(), source=None):
+        """write the file to writer, including the extra files includes"""
+        writer.add_autogen_comment(source=source)
+        writer.add_line()
+        if self.header:
+            guard = self.guard or self.default_guard(self.path)
+            writer.start_if_def(guard, invert=True)
+            writer.define(guard)
+            writer.add_line()
+        if self.includes or includes:
+            for file in self.includes + list(includes):
+                writer.include(file)
+            writer.add_line()
+
+        last = None
+        for kind, construct, extra in self.items:
+            if kind == 'use':
+                continue
+            # constructs are grouped by kind, blocks are always set apart
+            if last is not None and (kind != last or kind not in (
+                    'declaration', 'initialization', 'prototype')):
+                writer.add_line()
+            last = kind
+            if kind == 'struct':
+                writer.add_struct(construct)
+            elif kind == 'enum':
+                writer.add_enum(construct)
+            elif kind == 'declaration':
+                writer.add_variable_declaration(construct, extern=self.header)
+            elif kind == 'initialization':
+                writer.add_variable_initialization(construct)
+            elif kind == 'prototype':
+                writer.add_function_prototype(construct, comment=extra)
+            elif kind == 'definition':
+                body, comment = extra
+                writer.add_function_definition(construct, comment=comment)
+                writer.open_brace()
+                writer.add_lines(body)
+                writer.close_brace()
+            elif kind == 'dispatch':
+                writer.add_dispatch(construct)
+            else:
+                construct(writer, *extra)
+
+        if self.header:
+            writer.add_line()
+            writer.end_if_def()
+
+
+def _build_project_file(writer, file, includes, source):
+    """FileJob build of a ProjectFile"""
+    file.build(writer, includes, source)
+
+
+class Project:
+    """a set of generated headers and sources
+
+    Each file lists the constructs it emits. Files automatically include the
+    headers defining the types, variables and functions they use, which
+    gives the dependency graph: generate() writes the files in topological
+    order, each level in parallel. Paths are relative to directory.
+    """
+
+    def __init__(self, directory='.', source=None, lf="\n", indent=4):
+        self.directory = directory
+        self.source = source  # pointed to by the autogen comments
+        self.lf = lf
+        self.indent = indent
+        self.files = {}  # ProjectFile per path, in order of addition
+
+    def __add(self, file):
+        if file.path in self.files:
+            raise ValueError('file "{0}" is already part of the project'.format(
+                file.path))
+        self.files[file.path] = file
+        return file
+
+    def add_header(self, path, guard=None, includes=()):
+        """Return a new header file of the project."""
+        return self.__add(ProjectFile(path, True, guard, includes))
+
+    def add_source(self, path, includes=()):
+        """Return a new source file of the project."""
+        return self.__add(ProjectFile(path, False, None, includes))
+
+    def dependencies(self):
+        """Return the paths of the headers each file includes, by path."""
+        providers = {}
+        for file in self.files.values():
+            if not file.header:
+                continue
+            for name in file.provides():
+                other = providers.setdefault(name, file.path)
+                if other != file.path:
+                    raise ValueError(
+                        '{0} {1} is defined in both "{2}" and "{3}"'.format(
+                            name[0], name[1], other, file.path))
+
+        position = {path: i for i, path in enumerate(self.files)}
+        graph = {}
+        for path, file in self.files.items():
+            headers = {providers.get(name) for name in file.requires()}
+            headers -= {None, path}
+            graph[path] = sorted(headers, key=position.get)
+        return graph
+
+    def order(self):
+        """Return the paths in generation order, as lists of files that
+        only include files of earlier lists."""
+        graph = self.dependencies()
+        levels = []
+        done = set()
+        remaining = list(self.files)
+        while remaining:
+            level = [path for path in remaining
+                     if done.issuperset(graph[path])]
+            if not level:
+                raise ValueError('include cycle between {0}'.format(
+                    ', '.join('"{0}"'.format(path) for path in remaining)))
+            levels.append(level)
+            done.update(level)
+            remaining = [path for path in remaining if path not in done]
+        return levels
+
+    def jobs(self):
+        """Return a FileJob per file, by path."""
+        jobs = {}
+        for path, headers in self.dependencies().items():
+            directory = os.path.dirname(path)
+            includes = ['"{0}"'.format(
+                os.path.relpath(header, directory or os.curdir).replace(
+                    os.sep, '/')) for header in headers]
+            jobs[path] = FileJob(
+                os.path.join(self.directory, path), _build_project_file,
+                (self.files[path], includes, self.source), self.lf,
+                self.indent)
+        return jobs
+
+    def generate(self, processes=None, manifest=None):
+        """generate the files level by level of order()
+
+        As with generate_files, files are only rewritten when their code
+        changed and, with a manifest, files whose constructs and includes
+        did not change are skipped. Returns a JobResult per file, in
+        generation order.
+        """
+        jobs = self.jobs()
+        for job in jobs.values():
+            os.makedirs(os.path.dirname(os.path.abspath(job.path)),
+                        exist_ok=True)
+        results = []
+        pool = None
+        if processes != 1 and len(jobs) > 1:
+            pool = ProcessPoolExecutor(processes)
+        try:
+            for level in self.order():
+                results.extend(_generate(
+                    [jobs[path] for path in level], manifest, processes, pool))
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        if manifest is not None and manifest.path is not None:
+            manifest.save()
+        return results